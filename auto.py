@@ -29,6 +29,7 @@ import re
 import random
 import math
 import configparser
+import base64
 from subprocess import call
 import datetime
 import urllib.request, urllib.error, urllib.parse
@@ -36,12 +37,18 @@ from socket import timeout
 from shutil import copy, copytree, rmtree, get_terminal_size as tsize
 from zipfile import ZipFile
 import tempfile
+from functools import partial
 from PIL import Image, ImageChops
 import multiprocessing as mp
 
 from crop import crop
 from ref import ref
-from zoom import zoom, zoomRenderboxes
+from zoom import zoom, zoomRenderboxes, ZOOMMEMORY
+from pipeline import Pipeline
+from watch import Watcher, waitFor
+import chunks
+import codec
+import workers
 from updateLib import update as updateLib
 
 
@@ -67,7 +74,19 @@ kwargs = {
 	'cropthreads': None,
 	'refthreads': None,
 	'zoomthreads': None,
+	'zoommemory': None,
+	'thumbnailsize': None,
 	'screenshotthreads': None,
+	'corebudget': None,
+	'instances': None,
+	'memorybudget': None,
+	'workers': None,
+	'streamcrop': False,
+	'fused': False,
+	'tilestore': False,
+	'pack': False,
+	'tileformat': None,
+	'writebehind': False,
 	'delete': False,
 	'dry': False,
 	'surface': []
@@ -143,8 +162,7 @@ def startGameAndReadGameLogs(results, condition, popenArgs, tmpDir, pidBlacklist
 			attrs = ('pid', 'name', 'create_time')
 
 			# on some devices, the previous check wasn't enough apparently, so explicitely wait until the log file is created.
-			while not os.path.exists(os.path.join(tmpDir, "factorio-current.log")):
-				time.sleep(0.4)
+			waitFor(os.path.join(tmpDir, "factorio-current.log"), created=True)
 
 			oldest = None
 			pid = None
@@ -166,12 +184,12 @@ def startGameAndReadGameLogs(results, condition, popenArgs, tmpDir, pidBlacklist
 
 		if isSteam:
 			pipef.close()
-			with open(os.path.join(tmpDir, "factorio-current.log"), "r") as f:
+			with open(os.path.join(tmpDir, "factorio-current.log"), "r") as f, Watcher() as watcher:
 				while psutil.pid_exists(pid):
 					where = f.tell()
 					line = f.readline()
 					if not line:
-						time.sleep(0.4)
+						watcher.waitChange(os.path.join(tmpDir, "factorio-current.log"))
 						f.seek(where)
 					else:
 						printingStackTraceback = handleGameLine(line)
@@ -190,6 +208,8 @@ def startGameAndReadGameLogs(results, condition, popenArgs, tmpDir, pidBlacklist
 def auto(*args):
 
 	lock = threading.Lock()
+	# the games running next to each other read mapInfo.json to build their autorun.lua while the merges of finished saves write it.
+	mapInfoLock = threading.Lock()
 	def kill(pid, onlyStall=False):
 		if pid:
 			with lock:
@@ -198,7 +218,10 @@ def auto(*args):
 					if os.name == 'nt':
 						subprocess.check_call(("taskkill", "/pid", str(pid)), stdout=subprocess.DEVNULL, shell=True)
 					else:
-						subprocess.check_call(("killall", "factorio"), stdout=subprocess.DEVNULL)	# TODO: kill correct process instead of just killing all
+						try:
+							psutil.Process(pid).terminate()
+						except psutil.NoSuchProcess:
+							pass
 
 					while psutil.pid_exists(pid):
 						time.sleep(0.1)
@@ -235,6 +258,8 @@ def auto(*args):
 	newArgs = list(filter(parseArg, args))
 	if kwargs["verbose"]:
 		print(args)
+	# fail on a bad --tileformat before the game is started.
+	codec.parsePolicy(kwargs["tileformat"])
 	if len(newArgs) > 0:
 		foldername = newArgs[0]
 	else:
@@ -268,7 +293,6 @@ def auto(*args):
 	psutil.Process(os.getpid()).nice(psutil.ABOVE_NORMAL_PRIORITY_CLASS if os.name == 'nt' else 5)
 
 	basepath = os.path.join("../../script-output", kwargs["basepath"])
-	workthread = None
 
 	workfolder = os.path.join(basepath, foldername)
 	print("output folder: {}".format(os.path.relpath(workfolder, "../..")))
@@ -409,24 +433,183 @@ def auto(*args):
 
 
 
-	datapath = os.path.join(workfolder, "latest.txt")
 	allTmpDirs = []
+	pids = set()
 
 	isFirstSnapshot = True
 
-	try:
-
-		for index, savename in () if kwargs["dry"] else enumerate(savenames):
-
-
+	coreBudget = int(kwargs["corebudget"] or kwargs["maxthreads"])
+	memoryBudget = int(kwargs["memorybudget"]) if kwargs["memorybudget"] else int(psutil.virtual_memory().available * .8) // 2**20
+	pipeline = Pipeline(coreBudget, memoryBudget)
+	instances = int(kwargs["instances"] or 1)
+	# factorio mostly waits on the gpu while screenshotting, unless told otherwise the games get half of the budget.
+	gameCores = min(int(kwargs["screenshotthreads"] or max(1, coreBudget // (2 * instances))), coreBudget)
+	lastZooms = {}
+	lastOutInfoTask = None
+	# one pool of worker processes serves the crop, ref and zoom steps of every save.
+	workers.start(coreBudget, workfolder, kwargs)
+
+	# the steps get the cores the pipeline granted them as their thread count.
+	def cropStep(outFolder, key, cores):
+		crop(outFolder, *key, basepath, **dict(kwargs, cropthreads=cores))
+	def waitStep(waitlocalfilename, cores):
+		waitFor(waitlocalfilename)
+	def refStep(outFolder, key, cores):
+		ref(outFolder, *key, basepath, **dict(kwargs, refthreads=cores))
+	def zoomStep(outFolder, key, needsThumbnail, cores):
+		zoom(outFolder, *key, basepath, needsThumbnail, **dict(kwargs, zoomthreads=cores))
+	def renderboxStep(timestamp, daytimeSurfaces, firstOutFolder, cores):
+		print("zooming renderboxes", timestamp)
+		zoomRenderboxes(daytimeSurfaces, workfolder, timestamp, os.path.join(basepath, firstOutFolder, "Images"), **dict(kwargs, zoomthreads=cores))
+
+
+	def parseLatest(line):
+		otherInputs = list(map(lambda s: s.replace("|", " "), line.split(" ")))
+		return otherInputs.pop(0).replace("/", " "), tuple(otherInputs[:3])
+
+	def addCropTasks(latest):
+		for outFolder, key in map(parseLatest, latest):
+			if not kwargs["fused"]:
+				pipeline.add(("crop", outFolder, *key), partial(cropStep, outFolder, key), cores=int(kwargs["cropthreads"] or kwargs["maxthreads"]))
+			pipeline.add(("done", outFolder, *key), partial(waitStep, os.path.join(basepath, outFolder, "Images", *key, "done.txt")))
+
+	def addSnapshotTasks(index, latest, after=None):
+		"""adds the ref and zoom tasks of one save, saves have to be added in order. ref waits for the crop of its screenshots unless after is given."""
+		nonlocal lastOutInfoTask
+
+		timestamp = None
+		daytimeSurfaces = {}
+		snapshotZooms = []
+		for jindex, screenshot in enumerate(latest):
+			outFolder, key = parseLatest(screenshot)
+			print("Processing {}/{} ({} of {})".format(outFolder, "/".join(key), len(latest) * index + jindex + 1, len(latest) * len(savenames)))
+
+			timestamp = key[0]
+			if key[2] in daytimeSurfaces:
+				daytimeSurfaces[key[2]].append(key[1])
+			else:
+				daytimeSurfaces[key[2]] = [key[1]]
 
-			printErase("cleaning up")
-			if os.path.isfile(datapath):
-				os.remove(datapath)
+			# every screenshot line becomes crop -> ref -> zoom tasks. ref waits for the zoom of the previous snapshot of the same surface and daytime,
+			# and all ref and renderbox tasks run one after the other since they share mapInfo.out.json.
+			screenshotTasks = after if after is not None else (("crop", outFolder, *key) if not kwargs["fused"] else None, ("done", outFolder, *key))
+			lastOutInfoTask = pipeline.add(("ref", *key), partial(refStep, outFolder, key), after=(*screenshotTasks, lastZooms.get(key[1:]), lastOutInfoTask),
+										   cores=int(kwargs["refthreads"] or kwargs["maxthreads"]))
+			lastZooms[key[1:]] = pipeline.add(("zoom", *key), partial(zoomStep, outFolder, key, index + 1 == len(savenames)), after=(lastOutInfoTask,),
+											  cores=int(kwargs["zoomthreads"] or kwargs["maxthreads"]), memoryPerCore=int(kwargs["zoommemory"] or ZOOMMEMORY))
+			snapshotZooms.append(lastZooms[key[1:]])
 
+		lastOutInfoTask = pipeline.add(("renderboxes", timestamp), partial(renderboxStep, timestamp, daytimeSurfaces, parseLatest(latest[-1])[0]), after=(*snapshotZooms, lastOutInfoTask),
+									   cores=int(kwargs["zoomthreads"] or kwargs["maxthreads"]))
 
 
-			printErase("building autorun.lua")
+	modName = os.path.basename(os.path.abspath("."))
+	def linkFile(src, dest):
+		if os.path.isdir(dest):
+			linkDir(src, dest)
+		else:
+			try:
+				# hardlinks on windows, symlinks there need admin rights.
+				if os.name == 'nt':
+					os.link(os.path.abspath(dest), os.path.abspath(src))
+				else:
+					os.symlink(os.path.abspath(dest), os.path.abspath(src))
+			except OSError:
+				copy(dest, src)
+
+	def buildModDirectory(tmpDir):
+		# every game that runs next to others reads its own autorun.lua, so it gets a mod folder of its own with links to everything else.
+		modDirectory = os.path.join(tmpDir, "mods")
+		os.makedirs(os.path.join(modDirectory, modName))
+		for f in os.listdir(kwargs["modpath"]):
+			if f == "mod-list.json":
+				copy(os.path.join(kwargs["modpath"], f), os.path.join(modDirectory, f))
+			elif not re.match(r'^L0laapk3_FactorioMaps_', f, flags=re.IGNORECASE):
+				linkFile(os.path.join(modDirectory, f), os.path.join(kwargs["modpath"], f))
+		for f in os.listdir("."):
+			if f != "autorun.lua":
+				linkFile(os.path.join(modDirectory, modName, f), f)
+		return modDirectory, os.path.join(modDirectory, modName, "autorun.lua")
+
+
+	def mergeStep(gameName, latest, cores):
+		"""moves the output of a game that ran in its own folder into the timeline. runs in save order."""
+		gameFolder = os.path.join(basepath, gameName)
+		with open(os.path.join(gameFolder, "mapInfo.json"), "r") as f:
+			gameInfo = json.load(f)
+		with open(os.path.join(gameFolder, "chunkCache.json"), "r") as f:
+			gameCache = json.load(f)
+		if os.path.isfile(os.path.join(workfolder, "mapInfo.json")):
+			with open(os.path.join(workfolder, "mapInfo.json"), "r") as f:
+				mapInfo = json.load(f)
+		else:
+			mapInfo = dict(gameInfo, maps=[])
+		chunkCache = {}
+		if os.path.isfile(os.path.join(workfolder, "chunkCache.json")):
+			with open(os.path.join(workfolder, "chunkCache.json"), "r") as f:
+				chunkCache = json.load(f)
+
+		renames = {}
+		for filePath in dict.fromkeys(parseLatest(line)[1][0] for line in latest):
+			gameMap = next(m for m in gameInfo["maps"] if m["path"] == filePath)
+			same = [i for i, m in enumerate(mapInfo["maps"]) if m["path"] == filePath and m["tick"] == gameMap["tick"]]
+			if len(same) > 0:
+				# the same save was rendered before
+				mapInfo["maps"][same[0]] = gameMap
+			else:
+				# games that ran at the same time did not know about each other, pick the next free name the same way the mod does.
+				newPath = filePath
+				i = 1
+				while any(m["path"] == newPath for m in mapInfo["maps"]):
+					newPath = "%s-%s" % (filePath.split("-")[0], i)
+					i += 1
+				gameMap["path"] = newPath
+				mapInfo["maps"].append(gameMap)
+			renames[filePath] = gameMap["path"]
+			for surfaceName, chunks in gameCache.get(str(gameMap["tick"]), {}).items():
+				chunkCache.setdefault(str(gameMap["tick"]), {})[surfaceName] = chunks
+
+			dest = os.path.join(workfolder, "Images", gameMap["path"])
+			rmtree(dest, ignore_errors=True)
+			os.makedirs(os.path.dirname(dest), exist_ok=True)
+			os.replace(os.path.join(gameFolder, "Images", filePath), dest)
+			if gameMap["path"] != filePath:
+				# ref reads the crop lists of older snapshots, and with --fused of this one too.
+				for curdir, _, files in os.walk(dest):
+					if "crop.txt" in files:
+						with open(os.path.join(curdir, "crop.txt"), "r") as f:
+							lines = f.read().split("\n")
+						with open(os.path.join(curdir, "crop.txt"), "w") as f:
+							f.write("\n".join(lines[:1] + [re.sub(r'^((?:\S+ ){5})' + re.escape(filePath + "/"), lambda m: m.group(1) + gameMap["path"] + "/", line) for line in lines[1:]]))
+
+		with mapInfoLock:
+			for name, data in (("mapInfo.json", mapInfo), ("chunkCache.json", chunkCache)):
+				with open(os.path.join(workfolder, name + ".tmp"), "w") as f:
+					json.dump(data, f)
+				os.replace(os.path.join(workfolder, name + ".tmp"), os.path.join(workfolder, name))
+		rmtree(gameFolder)
+
+		return [" ".join([foldername.replace(" ", "/"), renames[key[0]].replace(" ", "|"), *(s.replace(" ", "|") for s in key[1:])]) for _, key in map(parseLatest, latest)]
+
+
+	def gameStep(index, savename, cores):
+		"""renders one save. with --instances the game writes to a folder of its own which is merged into the timeline afterwards."""
+		nonlocal isFirstSnapshot
+
+		staged = instances > 1
+		gameName = "%s.%s" % (foldername, index) if staged else foldername
+		gameDatapath = os.path.join(basepath, gameName, "latest.txt")
+
+		printErase("cleaning up")
+		if staged:
+			rmtree(os.path.join(basepath, gameName), ignore_errors=True)
+		elif os.path.isfile(gameDatapath):
+			os.remove(gameDatapath)
+
+
+
+		printErase("building autorun.lua")
+		with mapInfoLock:
 			if (os.path.isfile(os.path.join(workfolder, "mapInfo.json"))):
 				with open(os.path.join(workfolder, "mapInfo.json"), "r") as f:
 					mapInfoLua = re.sub(r'"([^"]+)" *:', lambda m: '["'+m.group(1)+'"] = ', f.read().replace("[", "{").replace("]", "}"))
@@ -449,71 +632,78 @@ def auto(*args):
 			else:
 				chunkCache = "{}"
 
-			with open("autorun.lua", "w") as f:
-				surfaceString = '{"' + '", "'.join(kwargs["surface"]) + '"}' if len(kwargs["surface"]) > 0 else "nil"
-				autorunString = (f'fm.autorun = {{\n'
-				f'HD = {str(kwargs["hd"] == True).lower()},\n'
-				f'day = {str(kwargs["nightonly"] != True).lower()},\n'
-				f'night = {str(kwargs["dayonly"] != True).lower()},\n'
-				f'alt_mode = {str(kwargs["no-altmode"] != True).lower()},\n'
-				f'tags = {str(kwargs["no-tags"] != True).lower()},\n'
-				f'around_tag_range = {float(kwargs["tag-range"])},\n'
-				f'around_build_range = {float(kwargs["build-range"])},\n'
-				f'around_connect_range = {float(kwargs["connect-range"])},\n'
-				f'connect_types = {{"lamp", "electric-pole", "radar", "straight-rail", "curved-rail", "rail-signal", "rail-chain-signal", "locomotive", "cargo-wagon", "fluid-wagon", "car"}},\n'
-				f'date = "{datetime.datetime.strptime(kwargs["date"], "%d/%m/%y").strftime("%d/%m/%y")}",\n'
-				f'surfaces = {surfaceString},\n'
-				f'name = "{foldername + "/"}",\n'
-				f'mapInfo = {mapInfoLua},\n'
-				f'chunkCache = {chunkCache},\n'
-				f'}}')
-				f.write(autorunString)
-				if kwargs["verbose"]:
-					printErase(autorunString)
-
-
-			printErase("building config.ini")
-			tmpDir = os.path.join(tempfile.gettempdir(), "FactorioMaps-%s" % random.randint(1, 999999999))
-			allTmpDirs.append(tmpDir)
-			try:
-				rmtree(tmpDir)
-			except (FileNotFoundError, NotADirectoryError):
-				pass
-			os.makedirs(os.path.join(tmpDir, "config"))
+		tmpDir = os.path.join(tempfile.gettempdir(), "FactorioMaps-%s" % random.randint(1, 999999999))
+		allTmpDirs.append(tmpDir)
+		try:
+			rmtree(tmpDir)
+		except (FileNotFoundError, NotADirectoryError):
+			pass
+		os.makedirs(os.path.join(tmpDir, "config"))
+
+		if staged:
+			modDirectory, autorunPath = buildModDirectory(tmpDir)
+		else:
+			modDirectory, autorunPath = kwargs["modpath"], "autorun.lua"
+
+		with open(autorunPath, "w") as f:
+			surfaceString = '{"' + '", "'.join(kwargs["surface"]) + '"}' if len(kwargs["surface"]) > 0 else "nil"
+			autorunString = (f'fm.autorun = {{\n'
+			f'HD = {str(kwargs["hd"] == True).lower()},\n'
+			f'day = {str(kwargs["nightonly"] != True).lower()},\n'
+			f'night = {str(kwargs["dayonly"] != True).lower()},\n'
+			f'alt_mode = {str(kwargs["no-altmode"] != True).lower()},\n'
+			f'tags = {str(kwargs["no-tags"] != True).lower()},\n'
+			f'around_tag_range = {float(kwargs["tag-range"])},\n'
+			f'around_build_range = {float(kwargs["build-range"])},\n'
+			f'around_connect_range = {float(kwargs["connect-range"])},\n'
+			f'connect_types = {{"lamp", "electric-pole", "radar", "straight-rail", "curved-rail", "rail-signal", "rail-chain-signal", "locomotive", "cargo-wagon", "fluid-wagon", "car"}},\n'
+			f'date = "{datetime.datetime.strptime(kwargs["date"], "%d/%m/%y").strftime("%d/%m/%y")}",\n'
+			f'surfaces = {surfaceString},\n'
+			f'name = "{gameName + "/"}",\n'
+			f'mapInfo = {mapInfoLua},\n'
+			f'chunkCache = {chunkCache},\n'
+			f'}}')
+			f.write(autorunString)
+			if kwargs["verbose"]:
+				printErase(autorunString)
 
-			configPath = os.path.join(tmpDir, "config/config.ini")
-			config = configparser.ConfigParser()
-			config.read("../../config/config.ini")
 
-			config["interface"]["show-tips-and-tricks"] = "false"
-			
-			config["path"]["write-data"] = tmpDir
-			config["graphics"]["screenshots-threads-count"] = str(int(kwargs["screenshotthreads" if kwargs["screenshotthreads"] else "maxthreads"]))
-			config["graphics"]["max-threads"] = config["graphics"]["screenshots-threads-count"]
+		printErase("building config.ini")
+		configPath = os.path.join(tmpDir, "config/config.ini")
+		config = configparser.ConfigParser()
+		config.read("../../config/config.ini")
+
+		config["interface"]["show-tips-and-tricks"] = "false"
+		
+		config["path"]["write-data"] = tmpDir
+		config["graphics"]["screenshots-threads-count"] = str(int(kwargs["screenshotthreads" if kwargs["screenshotthreads"] else "maxthreads"]))
+		config["graphics"]["max-threads"] = config["graphics"]["screenshots-threads-count"]
+		
+		with open(configPath, 'w+') as outf:
+			outf.writelines(("; version=3\n", ))
+			config.write(outf, space_around_delimiters=False)
 			
-			with open(configPath, 'w+') as outf:
-				outf.writelines(("; version=3\n", ))
-				config.write(outf, space_around_delimiters=False)
-				
 
-			linkDir(os.path.join(tmpDir, "script-output"), "../../script-output")
-			copy("../../player-data.json", os.path.join(tmpDir, "player-data.json"))
+		linkDir(os.path.join(tmpDir, "script-output"), "../../script-output")
+		copy("../../player-data.json", os.path.join(tmpDir, "player-data.json"))
 
-			pid = None
-			isSteam = None
-			pidBlacklist = [p.info["pid"] for p in psutil.process_iter(attrs=['pid', 'name']) if p.info['name'] == "factorio.exe"]
+		pid = None
+		isSteam = None
+		pidBlacklist = [p.info["pid"] for p in psutil.process_iter(attrs=['pid', 'name']) if p.info['name'] == "factorio.exe"]
 
-			popenArgs = (factorioPath, '--load-game', os.path.abspath(os.path.join("../../saves", savename)), '--disable-audio', '--config', configPath, "--mod-directory", os.path.abspath(kwargs["modpath"]), "--disable-migration-window")
-			if kwargs["verbose"]:
-				printErase(popenArgs)
+		popenArgs = (factorioPath, '--load-game', os.path.abspath(os.path.join("../../saves", savename)), '--disable-audio', '--config', configPath, "--mod-directory", os.path.abspath(modDirectory), "--disable-migration-window")
+		if kwargs["verbose"]:
+			printErase(popenArgs)
 
 
-			condition = mp.Condition()
+		condition = mp.Condition()
 
 
-			results = manager.list()
+		results = manager.list()
 
-			printErase("starting factorio")
+		printErase("starting factorio")
+		pipeline.reserve(gameCores)
+		try:
 			startLogProcess = mp.Process(target=startGameAndReadGameLogs, args=(results, condition, popenArgs, tmpDir, pidBlacklist, rawTags), kwargs=kwargs)
 			startLogProcess.daemon = True
 			startLogProcess.start()
@@ -528,20 +718,20 @@ def auto(*args):
 				raise Exception("isSteam error")
 			if pid is None:
 				raise Exception("pid error")
+			pids.add(pid)
 				
 
 
 
-			while not os.path.exists(datapath):
-				time.sleep(0.4)
+			waitFor(gameDatapath)
 			
 
-			open("autorun.lua", 'w').close()
+			open(autorunPath, 'w').close()
 
 				
 
 			latest = []
-			with open(datapath, 'r') as f:
+			with open(gameDatapath, 'r') as f:
 				for line in f:
 					latest.append(line.rstrip("\n"))
 			if kwargs["verbose"]:
@@ -555,82 +745,46 @@ def auto(*args):
 			
 			isKilled = [False]
 			def waitKill(isKilled, pid):
-				while not isKilled[0]:
-					#print(f"Can I kill yet? {os.path.isfile(waitfilename)} {waitfilename}")
-					if os.path.isfile(waitfilename):
-						isKilled[0] = True
-						kill(pid)
-						break
-					else:
-						time.sleep(0.4)
+				if waitFor(waitfilename, lambda: isKilled[0]) and not isKilled[0]:
+					isKilled[0] = True
+					kill(pid)
 
 			killThread = threading.Thread(target=waitKill, args=(isKilled, pid))
 			killThread.daemon = True
 			killThread.start()
 
 
-
-			if workthread and workthread.isAlive():
-				#print("waiting for workthread")
-				workthread.join()
-
-
+			addCropTasks(latest)
+			if not staged:
+				addSnapshotTasks(index, latest)
 
 
+			waitFor(waitfilename)
 
-			timestamp = None
-			daytimeSurfaces = {}
-			for jindex, screenshot in enumerate(latest):
-				otherInputs = list(map(lambda s: s.replace("|", " "), screenshot.split(" ")))
-				outFolder = otherInputs.pop(0).replace("/", " ")
-				print("Processing {}/{} ({} of {})".format(outFolder, "/".join(otherInputs), len(latest) * index + jindex + 1, len(latest) * len(savenames)))
-
-				timestamp = otherInputs[0]
-				if otherInputs[2] in daytimeSurfaces:
-					daytimeSurfaces[otherInputs[2]].append(otherInputs[1])
-				else:
-					daytimeSurfaces[otherInputs[2]] = [otherInputs[1]]
-
-				#print("Cropping %s images" % screenshot)
-				crop(outFolder, otherInputs[0], otherInputs[1], otherInputs[2], basepath, **kwargs)
-				waitlocalfilename = os.path.join(basepath, outFolder, "Images", otherInputs[0], otherInputs[1], otherInputs[2], "done.txt")
-				if not os.path.exists(waitlocalfilename):
-					#print("waiting for done.txt")
-					while not os.path.exists(waitlocalfilename):
-						time.sleep(0.4)
-
+			startLogProcess.terminate()
 
+			# I have receieved a bug report from feidan in which he describes what seems like that this doesnt kill factorio?
+			
+			onlyStall = isKilled[0]
+			isKilled[0] = True
+			kill(pid, onlyStall)
+			pids.discard(pid)
+		finally:
+			pipeline.release(gameCores)
 
-				def refZoom():
-					needsThumbnail = index + 1 == len(savenames)
-					#print("Crossreferencing %s images" % screenshot)
-					ref(outFolder, otherInputs[0], otherInputs[1], otherInputs[2], basepath, **kwargs)
-					#print("downsampling %s images" % screenshot)
-					zoom(outFolder, otherInputs[0], otherInputs[1], otherInputs[2], basepath, needsThumbnail, **kwargs)
+		if staged:
+			# the merge has to wait for the crops, they work on the files it moves.
+			pipeline.add(("merge", index), lambda cores: addSnapshotTasks(index, mergeStep(gameName, latest, cores), (("merge", index),)),
+						 after=(("merge", index - 1) if index > 0 else None, *(task for _, key in map(parseLatest, latest) for task in (("crop", gameName, *key) if not kwargs["fused"] else None, ("done", gameName, *key)))))
 
-					if jindex == len(latest) - 1:
-						print("zooming renderboxes", timestamp)
-						zoomRenderboxes(daytimeSurfaces, workfolder, timestamp, os.path.join(basepath, firstOutFolder, "Images"), **kwargs)
 
-				if screenshot != latest[-1]:
-					refZoom()
-				else:
-					
-					startLogProcess.terminate()
-
-					# I have receieved a bug report from feidan in which he describes what seems like that this doesnt kill factorio?
-					
-					onlyStall = isKilled[0]
-					isKilled[0] = True
-					kill(pid, onlyStall)
+	try:
 
-					if savename == savenames[-1]:
-						refZoom()
+		for index, savename in () if kwargs["dry"] else enumerate(savenames):
+			# a game needs the mapInfo.json of the saves before it, so only --instances games run at once. their cores are reserved once they start.
+			pipeline.add(("game", index), partial(gameStep, index, savename), after=(("game", index - instances) if index >= instances else None,))
 
-					else:
-						workthread = threading.Thread(target=refZoom)
-						workthread.daemon = True
-						workthread.start()
+		pipeline.join()
 
 			
 
@@ -645,9 +799,12 @@ def auto(*args):
 			with open(os.path.join(workfolder, "mapInfo.json"), 'r+') as destf, open(os.path.join(workfolder, "mapInfo.out.json"), "r") as srcf:
 				data = json.load(destf)
 				for mapIndex, mapStuff in json.load(srcf)["maps"].items():
+					if "extensions" in mapStuff:
+						data["maps"][int(mapIndex)]["extensions"] = mapStuff["extensions"]
 					for surfaceName, surfaceStuff in mapStuff["surfaces"].items():
-						if "chunks" in surfaceStuff:
-							data["maps"][int(mapIndex)]["surfaces"][surfaceName]["chunks"] = surfaceStuff["chunks"]
+						if "chunkIndex" in surfaceStuff:
+							data["maps"][int(mapIndex)]["surfaces"][surfaceName]["chunkIndex"] = surfaceStuff["chunkIndex"]
+							data["maps"][int(mapIndex)]["surfaces"][surfaceName].pop("chunks", None)
 						for linkIndex, link in enumerate(surfaceStuff["links"]):
 							data["maps"][int(mapIndex)]["surfaces"][surfaceName]["links"][linkIndex]["path"] = link["path"]
 							data["maps"][int(mapIndex)]["surfaces"][surfaceName]["links"][linkIndex]["zoom"]["min"] = link["zoom"]["min"]
@@ -740,9 +897,31 @@ def auto(*args):
 
 		print("generating mapInfo.js")
 		with open(os.path.join(workfolder, "mapInfo.js"), 'w') as outf, open(os.path.join(workfolder, "mapInfo.json"), "r") as inf:
+			mapInfoRaw = inf.read()
 			outf.write('"use strict";\nwindow.mapInfo = JSON.parse(')
-			outf.write(json.dumps(inf.read()))
+			outf.write(json.dumps(mapInfoRaw))
 			outf.write(");")
+			# the binary chunk indexes are embedded as well since browsers refuse to fetch them when the map is opened from file://
+			chunkIndexes = {}
+			for mapStuff in json.loads(mapInfoRaw)["maps"]:
+				for surfaceStuff in mapStuff["surfaces"].values():
+					if "chunkIndex" in surfaceStuff and os.path.isfile(os.path.join(workfolder, surfaceStuff["chunkIndex"])):
+						with open(os.path.join(workfolder, surfaceStuff["chunkIndex"]), "rb") as f:
+							chunkIndexes[surfaceStuff["chunkIndex"]] = base64.b64encode(f.read()).decode("ascii")
+			outf.write('\nwindow.chunkIndexes = ')
+			outf.write(json.dumps(chunkIndexes))
+			outf.write(";")
+			solidIndexes = {}
+			for mapStuff in json.loads(mapInfoRaw)["maps"]:
+				for surfaceName in mapStuff["surfaces"]:
+					for daytime in ("day", "night"):
+						solidIndex = "/".join(("Images", mapStuff["path"], surfaceName, daytime, chunks.SOLIDFILE))
+						if os.path.isfile(os.path.join(workfolder, solidIndex)):
+							with open(os.path.join(workfolder, solidIndex), "rb") as f:
+								solidIndexes[solidIndex] = base64.b64encode(f.read()).decode("ascii")
+			outf.write('\nwindow.solidIndexes = ')
+			outf.write(json.dumps(solidIndexes))
+			outf.write(";")
 			
 			
 		print("creating index.html")
@@ -759,15 +938,19 @@ def auto(*args):
 
 	except KeyboardInterrupt:
 		print("keyboardinterrupt")
-		kill(pid)
+		for pid in list(pids):
+			kill(pid)
 		raise
 
 	finally:
 
-		try:
-			kill(pid)
-		except:
-			pass
+		workers.stop()
+
+		for pid in list(pids):
+			try:
+				kill(pid)
+			except:
+				pass
 
 		print("disabling FactorioMaps mod")
 		changeModlist(False)
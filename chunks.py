@@ -0,0 +1,60 @@
+import os
+import numpy
+
+
+
+CHUNKFILE = "chunks.bin"
+MAGIC = b"FMCI"
+VERSION = 1
+HEADERSIZE = 12
+
+SOLIDFILE = "solid.bin"
+SOLIDMAGIC = b"FMSO"
+
+# the client index of one surface of one snapshot: which max zoom images that snapshot rendered, and whether they exist in daytime or only at night.
+# web/index.js only decodes the rows it needs to show the current viewport.
+# layout (little endian): header with the version and row count,
+# a row table sorted by y of (int32 y, uint32 first run, uint32 run count),
+# then all runs as (int32 start x, uint32 length << 1 | day bit).
+
+
+
+def runs(xs, isDay):
+	"""run length encodes the sorted x coordinates of one row, a run breaks on gaps and where the day bit changes."""
+	result = []
+	for x in xs:
+		day = isDay(x)
+		if len(result) > 0 and result[-1][0] + result[-1][1] == x and result[-1][2] == day:
+			result[-1][1] += 1
+		else:
+			result.append([x, 1, day])
+	return result
+
+
+def save(path, rows):
+	"""rows maps y to the sorted run list of that row as returned by runs()."""
+	table = []
+	data = []
+	for y in sorted(rows):
+		table.append((y, len(data), len(rows[y])))
+		data.extend(rows[y])
+
+	with open(path + ".tmp", "wb") as f:
+		f.write(MAGIC + numpy.array((VERSION, 0), dtype="<u2").tobytes() + numpy.array(len(table), dtype="<u4").tobytes())
+		f.write(numpy.array(table, dtype=numpy.dtype([("y", "<i4"), ("first", "<u4"), ("count", "<u4")])).tobytes())
+		f.write(numpy.array([(x, length << 1 | day) for x, length, day in data], dtype=numpy.dtype([("x", "<i4"), ("value", "<u4")])).tobytes())
+	os.replace(path + ".tmp", path)
+
+
+# zoom does not save tiles that are nothing but background, solid.bin next to a surface/daytime's tiles lists the ones of that snapshot so the viewer can draw them itself.
+# layout (little endian): header with the version and tile count, then the sorted (int32 z, int32 x, int32 y) of every solid tile.
+
+def saveSolid(path, tiles):
+	if len(tiles) == 0:
+		if os.path.isfile(path):
+			os.remove(path)
+		return
+	with open(path + ".tmp", "wb") as f:
+		f.write(SOLIDMAGIC + numpy.array((VERSION, 0), dtype="<u2").tobytes() + numpy.array(len(tiles), dtype="<u4").tobytes())
+		f.write(numpy.array(sorted(tiles), dtype="<i4").tobytes())
+	os.replace(path + ".tmp", path)
@@ -0,0 +1,215 @@
+import os, sys, time, threading
+import numpy
+from turbojpeg import TurboJPEG, TJPF_RGB
+from PIL import Image
+from io import BytesIO
+
+import pack
+
+
+
+# note that these are all 64 bit libraries since factorio doesnt support 32 bit.
+if os.name == "nt":
+	jpeg = TurboJPEG("mozjpeg/turbojpeg.dll")
+# elif _platform == "darwin":						# I'm not actually sure if mac can run linux libraries or not.
+# 	jpeg = TurboJPEG("mozjpeg/libturbojpeg.dylib")	# If anyone on mac has problems with the line below please make an issue :)
+else:
+	jpeg = TurboJPEG("mozjpeg/libturbojpeg.so")
+
+
+JPEGSCALES = (1, 2, 4, 8)
+QUADRANTS = ((0, 0), (1, 0), (0, 1), (1, 1))
+
+JPEGMAGIC = b"\xff\xd8"
+
+# every worker thread encodes into its own output buffer, grown to the largest tile size it has seen.
+_scratch = threading.local()
+
+# --tileformat picks the encoder of every zoom level, see configure(). levels it does not cover are jpg.
+_policy = ()
+
+
+
+def loadTile(path, scale=1):
+	"""Decodes a tile from disk or its pack to an RGB uint8 array, reduced by scale.
+	jpg tiles are decoded at the reduced size directly by libturbojpeg's DCT scaling, so the full size image is never built."""
+	if os.path.isfile(path):
+		with open(path, "rb") as f:
+			data = f.read()
+	else:
+		data = pack.read(path)
+		if data is None:
+			raise FileNotFoundError(path)
+
+	# packed tiles are looked up without their extension, the data tells what format it is.
+	if scale in JPEGSCALES and data[:2] == JPEGMAGIC:
+		return jpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=(1, scale) if scale > 1 else None)
+
+	img = Image.open(BytesIO(data), mode='r').convert("RGB")
+	if scale > 1:
+		img = img.resize((img.size[0] // scale, img.size[1] // scale), Image.BOX)
+	return numpy.asarray(img)
+
+
+def encode(arr, quality=85):
+	"""Encodes an RGB uint8 array to jpeg. The array is handed to libturbojpeg as is (only copied if it is not contiguous), there is no channel swap.
+	Returns a memoryview of the worker's scratch buffer, it is overwritten by the next encode() on the same thread."""
+	if not hasattr(jpeg, "buffer_size"):
+		# PyTurboJPEG before 1.8 cannot encode into a given buffer.
+		return memoryview(jpeg.encode(numpy.ascontiguousarray(arr), quality=quality, pixel_format=TJPF_RGB))
+	size = jpeg.buffer_size(arr)
+	if len(getattr(_scratch, "buffer", b"")) < size:
+		_scratch.buffer = bytearray(size)
+	_, length = jpeg.encode(arr, quality=quality, pixel_format=TJPF_RGB, dst=_scratch.buffer)
+	return memoryview(_scratch.buffer)[:length]
+
+
+def encodeWebp(arr, quality=80):
+	out = BytesIO()
+	Image.fromarray(arr).save(out, format="WEBP", quality=quality)
+	return out.getbuffer()
+
+
+def encodePng(arr, colors=256):
+	# colors is the size of the palette, 0 keeps every color.
+	img = Image.fromarray(arr)
+	if colors > 0:
+		img = img.quantize(colors, method=Image.FASTOCTREE)
+	out = BytesIO()
+	img.save(out, format="PNG", optimize=colors > 0)
+	return out.getbuffer()
+
+
+# name: (extension, encoder, default quality)
+ENCODERS = {
+	"jpg": (".jpg", encode, 85),
+	"webp": (".webp", encodeWebp, 80),
+	"png": (".png", encodePng, 256),
+}
+
+
+def parsePolicy(spec):
+	"""parses --tileformat: comma separated FORMAT[:QUALITY][@LEVELS] entries, LEVELS is a zoom level or a range like 12-14, -14 or 18-.
+	the first entry that covers a level is used. for png the quality is the number of palette colors."""
+	policy = []
+	for entry in (spec if isinstance(spec, str) else "").split(","):
+		if entry == "":
+			continue
+		entry, _, levels = entry.partition("@")
+		name, _, quality = entry.partition(":")
+		if name not in ENCODERS:
+			raise ValueError('Unknown tile format "%s", pick one of %s' % (name, ", ".join(ENCODERS)))
+		low, high = float("-inf"), float("inf")
+		if levels != "":
+			low, separator, high = levels.partition("-")
+			low = int(low) if low != "" else float("-inf")
+			high = int(high) if high != "" else (float("inf") if separator else low)
+		policy.append((low, high, name, int(quality) if quality != "" else ENCODERS[name][2]))
+	return tuple(policy)
+
+
+def configure(spec):
+	"""called in every process that saves or looks up tiles, spec is the value of --tileformat."""
+	global _policy
+	_policy = parsePolicy(spec)
+
+
+def tileFormat(z):
+	for low, high, name, quality in _policy:
+		if low <= z <= high:
+			return name, quality
+	return "jpg", ENCODERS["jpg"][2]
+
+
+def extension(z):
+	return ENCODERS[tileFormat(z)[0]][0]
+
+
+def encodeTile(arr, z):
+	name, quality = tileFormat(z)
+	return ENCODERS[name][1](arr, quality)
+
+
+def tileFile(path, z):
+	"""returns path (without extension) with the extension the tile was saved with, trying the format of level z first.
+	tiles of older snapshots can be in another format if --tileformat changed since. None if there is no such tile."""
+	for ext in sorted(set(e for e, _, _ in ENCODERS.values()), key=lambda e: e != extension(z)):
+		if pack.exists(path + ext):
+			return path + ext
+	return None
+
+
+def sniffExtension(data):
+	if data[:2] == JPEGMAGIC:
+		return ".jpg"
+	if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+		return ".webp"
+	return ".png"
+
+
+def downsample(arr):
+	"""Halves a uint8 image with a 2x2 box filter, every pixel is the rounded mean of the four below it. Odd edges are dropped like PIL's resize does."""
+	h, w = arr.shape[0] // 2, arr.shape[1] // 2
+	arr = arr[:h*2, :w*2]
+	# add the row pairs first, the column pairs are then neighbours in memory. summing over a reshaped view instead is about ten times slower.
+	rows = arr[0::2].astype(numpy.uint16)
+	rows += arr[1::2]
+	rows = rows.reshape(h, w, 2, -1)
+	total = rows[:, :, 0] + rows[:, :, 1]
+	total += 2
+	total >>= 2
+	return total.astype(numpy.uint8)
+
+
+def isSolid(arr, color):
+	"""True if every pixel of arr is color. Tiles with any content usually differ in the first pixel already, so only candidates are compared in full."""
+	return arr[0, 0].tolist() == list(color) and not (arr != arr[0, 0]).any()
+
+
+def solidTile(size, color):
+	tile = numpy.empty((size, size, 3), dtype=numpy.uint8)
+	tile[:] = color
+	return tile
+
+
+def combine(quadrants, size, background):
+	"""Builds a size by size parent tile from four half size arrays in QUADRANTS order, None quadrants are filled with the background color.
+	The result is a contiguous uint8 array that can go to the jpeg encoder as is."""
+	half = size // 2
+	parent = numpy.empty((size, size, 3), dtype=numpy.uint8)
+	for (x, y), quadrant in zip(QUADRANTS, quadrants):
+		parent[y*half:(y+1)*half, x*half:(x+1)*half] = background if quadrant is None else quadrant
+	return parent
+
+
+
+
+
+def compare(*paths):
+	"""Compares downsample() to the PIL ANTIALIAS resize it replaced on the given tiles: speed and the PSNR between both results."""
+	for path in paths:
+		img = Image.open(path, mode='r').convert("RGB")
+		arr = numpy.asarray(img)
+		size = (img.size[0] // 2, img.size[1] // 2)
+		runs = max(1, int(2**22 // arr.size))
+
+		t = time.perf_counter()
+		for _ in range(runs):
+			pil = img.resize(size, Image.ANTIALIAS)
+		pilTime = (time.perf_counter() - t) / runs
+		t = time.perf_counter()
+		for _ in range(runs):
+			box = downsample(arr)
+		boxTime = (time.perf_counter() - t) / runs
+
+		diff = numpy.asarray(pil, dtype=numpy.float64) - box
+		mse = numpy.mean(diff**2)
+		psnr = float("inf") if mse == 0 else 10 * numpy.log10(255**2 / mse)
+		print("%s: ANTIALIAS %.2fms, box %.2fms (%.1fx), PSNR %.1fdB, max difference %d" % (path, pilTime * 1000, boxTime * 1000, pilTime / boxTime, psnr, numpy.abs(diff).max()))
+
+
+
+
+
+if __name__ == '__main__':
+	compare(*sys.argv[1:])
@@ -1,15 +1,23 @@
 from PIL import Image
 import multiprocessing as mp
-import os, math, sys, time, psutil, json
+import io, os, math, sys, time, psutil, json, queue
 from functools import partial
 from shutil import get_terminal_size as tsize
+from watch import waitFor
+import workers
+import writebehind
 
 
 
 	
 ext = ".png"
 
-def work(line, folder, progressQueue):
+CROPBATCH = 16
+
+STREAMPOLLINTERVAL = 0.25
+PNGTRAILER = b"IEND\xaeB`\x82"
+
+def cropLine(line, folder):
 	arg = line.rstrip('\n').split(" ", 5)
 	path = os.path.join(folder, arg[5])
 	top = int(arg[0])
@@ -17,19 +25,83 @@ def work(line, folder, progressQueue):
 	width = int(arg[2])
 	height = int(arg[3])
 		
+	data = io.BytesIO()
+	Image.open(path).convert("RGB").crop((top, left, top + width, left + height)).save(data, format="PNG")
+	# the screenshot is only replaced by writebehind.flush(), the callers flush before anything reads it again.
+	writebehind.write(path, data.getbuffer())
+
+
+def cropAll(lines, folder):
+	for line in lines:
+		cropLine(line, folder)
+	writebehind.flush()
+
+
+def work(lines, folder):
+	# returns the screenshots the game has not finished writing yet, and how many were cropped.
+	retry = []
+	doneSize = 0
+	for line in lines:
+		try:
+			cropLine(line, folder)
+			doneSize += 1
+		except IOError:
+			retry.append(line)
+		except:
+			import traceback
+			traceback.print_exc()
+	writebehind.flush()
+	return retry, doneSize
+
+
+def isWritten(path, lastSize):
+	# the game writes screenshots in the background, a file is considered complete once its size stops changing and the png trailer is there.
+	try:
+		size = os.path.getsize(path)
+	except OSError:
+		return False, None
+	if size == 0 or size != lastSize:
+		return False, size
 	try:
-		Image.open(path).convert("RGB").crop((top, left, top + width, left + height)).save(path)
-	except IOError:
-		progressQueue.put(False, True)
-		return line
-	except:
-		progressQueue.put(False, True)
-		import traceback
-		traceback.print_exc()
-		pass
-		return False
-	progressQueue.put(True, True)
-	return False
+		with open(path, "rb") as f:
+			f.seek(-len(PNGTRAILER), os.SEEK_END)
+			return f.read() == PNGTRAILER, size
+	except OSError:
+		return False, None
+
+
+def stream(files, basepath, pool, maxthreads, printProgress):
+	# finished screenshots are cropped in batches like work() does, with at most 2 batches per thread queued on the shared pool at a time.
+	pending = { line: None for line in files }
+	ready = []
+	doneQueue = queue.Queue()
+	inFlight = 0
+	doneSize = 0
+	while len(pending) > 0 or len(ready) > 0 or inFlight > 0:
+		for line, lastSize in list(pending.items()):
+			written, pending[line] = isWritten(os.path.join(basepath, line.rstrip('\n').split(" ", 5)[5]), lastSize)
+			if written:
+				del pending[line]
+				ready.append(line)
+		while len(ready) > 0 and inFlight < 2 * maxthreads:
+			batch, ready = ready[:CROPBATCH], ready[CROPBATCH:]
+			inFlight += 1
+			pool.apply_async(work, (batch, basepath), callback=doneQueue.put, error_callback=doneQueue.put)
+
+		try:
+			result = doneQueue.get(True, STREAMPOLLINTERVAL)
+			while True:
+				inFlight -= 1
+				if isinstance(result, BaseException):
+					raise result
+				retry, done = result
+				doneSize += done
+				printProgress(doneSize)
+				for line in retry:
+					pending[line] = None
+				result = doneQueue.get(False)
+		except queue.Empty:
+			pass
 
 		
 
@@ -50,10 +122,8 @@ def crop(*args, **kwargs):
 	maxthreads = int(kwargs["cropthreads" if kwargs["cropthreads"] else "maxthreads"])
 
 
-	if not os.path.exists(datapath):
-		#print("waiting for game")
-		while not os.path.exists(datapath):
-			time.sleep(1)
+	#print("waiting for game")
+	waitFor(datapath)
 
 	print("crop {:5.1f}% [{}]".format(0, " " * (tsize()[0]-15)), end="")
 	
@@ -63,25 +133,28 @@ def crop(*args, **kwargs):
 		for line in data:
 			files.append(line)
 	
-	pool = mp.Pool(processes=maxthreads)
+	pool = workers.acquire(maxthreads, options=kwargs)
 	
-	m = mp.Manager()
-	progressQueue = m.Queue()
 	originalSize = len(files)
 	doneSize = 0
+	def printProgress(doneSize):
+		progress = float(doneSize) / originalSize
+		tsiz = tsize()[0]-15
+		print("\rcrop {:5.1f}% [{}{}]".format(round(progress * 100, 1), "=" * int(progress * tsiz), " " * (tsiz - int(progress * tsiz))), end="")
+
 	try:
-		while len(files) > 0:
-			workers = pool.map_async(partial(work, folder=basepath, progressQueue=progressQueue), files, 128)
-			for _ in range(len(files)):
-				if progressQueue.get(True):
-					doneSize += 1
-					progress = float(doneSize) / originalSize
-					tsiz = tsize()[0]-15
-					print("\rcrop {:5.1f}% [{}{}]".format(round(progress * 100, 1), "=" * int(progress * tsiz), " " * (tsiz - int(progress * tsiz))), end="")
-			workers.wait()
-			files = [x for x in workers.get() if x]
-			if len(files) > 0:
-				time.sleep(10 if len(files) > 1000 else 1)
+		if kwargs.get("streamcrop"):
+			stream(files, basepath, pool, maxthreads, printProgress)
+		else:
+			def batchDone(result):
+				nonlocal doneSize
+				doneSize += result[1]
+				printProgress(doneSize)
+			while len(files) > 0:
+				results = workers.runBatches(pool, partial(work, folder=basepath), [files[i:i+CROPBATCH] for i in range(0, len(files), CROPBATCH)], maxthreads, batchDone)
+				files = [line for retry, _ in results for line in retry]
+				if len(files) > 0:
+					time.sleep(10 if len(files) > 1000 else 1)
 		print("\rcrop {:5.1f}% [{}]".format(100, "=" * (tsize()[0]-15)))
 	except KeyboardInterrupt:
 
@@ -93,6 +166,8 @@ def crop(*args, **kwargs):
 
 		raise
 
+	workers.release(pool)
+
 
 
 
@@ -0,0 +1,98 @@
+import os, threading
+import numpy
+
+from signatures import key
+
+
+
+OWNERFILE = "owners.bin"
+MAGIC = b"FMOWN\x00\x00\x01"
+HEADERSIZE = 16
+
+# maps every max zoom (x, y) of a surface/daytime to the index of the snapshot that last changed it, as seen from the snapshot the file belongs to.
+# ref.py writes one next to ref.txt after every run, building on the file of the previous snapshot.
+# layout: header with the zoom level and count, sorted int64 (x, y) keys, int32 snapshot indices in the same order.
+
+# workers live for a whole auto() run, only the indexes of the last few snapshots are kept open.
+OPENINDEXES = 8
+_openIndexes = {}
+_lock = threading.Lock()
+
+
+
+def save(path, z, owners):
+	keys = numpy.array([key(x, y) for x, y in owners.keys()], dtype=numpy.int64)
+	values = numpy.array(list(owners.values()), dtype=numpy.int32)
+	order = numpy.argsort(keys, kind="stable")
+	with open(path + ".tmp", "wb") as f:
+		f.write(MAGIC + numpy.array((z, len(keys)), dtype=numpy.uint32).tobytes())
+		f.write(keys[order].tobytes())
+		f.write(values[order].tobytes())
+	os.replace(path + ".tmp", path)
+
+
+def load(path):
+	try:
+		with open(path, "rb") as f:
+			header = f.read(HEADERSIZE)
+			if header[:len(MAGIC)] != MAGIC:
+				return None
+			z, count = numpy.frombuffer(header, dtype=numpy.uint32, count=2, offset=len(MAGIC)).tolist()
+			keys = numpy.frombuffer(f.read(count * 8), dtype=numpy.int64)
+			values = numpy.frombuffer(f.read(count * 4), dtype=numpy.int32)
+	except FileNotFoundError:
+		return None
+	return z, keys, values
+
+
+def toDict(index):
+	_, keys, values = index
+	return dict(zip(zip((keys >> 32).tolist(), (keys & 0xffffffff).astype(numpy.uint32).view(numpy.int32).tolist()), values.tolist()))
+
+
+
+
+class OwnerIndex:
+	"""constant time lookups of the newest snapshot that has a tile, at any zoom level."""
+
+	def __init__(self, index):
+		self.z, keys, values = index
+		self.xs = keys >> 32
+		self.ys = (keys & 0xffffffff).astype(numpy.uint32).view(numpy.int32).astype(numpy.int64)
+		self.values = values
+		self.levels = {}
+
+	def level(self, z):
+		# a tile on a lower zoom level was last rendered by the newest snapshot that owns any of the max zoom tiles below it.
+		if z not in self.levels:
+			shift = self.z - z
+			keys = (self.xs >> shift << 32) | ((self.ys >> shift) & 0xffffffff)
+			order = numpy.lexsort((self.values, keys))
+			keys, values = keys[order], self.values[order]
+			if len(keys) > 0:
+				last = numpy.append(keys[1:] != keys[:-1], True)
+				keys, values = keys[last], values[last]
+			self.levels[z] = (keys, values)
+		return self.levels[z]
+
+	def lookup(self, z, x, y):
+		keys, values = self.level(z)
+		k = key(x, y)
+		i = numpy.searchsorted(keys, k)
+		if i < len(keys) and keys[i] == k:
+			return int(values[i])
+		return None
+
+
+def cachedIndex(path):
+	try:
+		cacheKey = (path, os.path.getmtime(path))
+	except OSError:
+		return None
+	with _lock:
+		if cacheKey not in _openIndexes:
+			while len(_openIndexes) >= OPENINDEXES:
+				del _openIndexes[next(iter(_openIndexes))]
+			index = load(path)
+			_openIndexes[cacheKey] = OwnerIndex(index) if index is not None else None
+		return _openIndexes[cacheKey]
@@ -0,0 +1,143 @@
+import os, sys, sqlite3, threading
+
+
+
+PACKFILE = "tiles.sqlite"
+BATCHSIZE = 64
+
+# with --pack the tiles of every snapshot/surface/daytime go into one sqlite file next to ref.txt instead of a <z>/<x>/<y>.jpg tree.
+# tiles keep their usual paths everywhere in the code, locate() maps such a path to its pack and key. the key has no extension, the format is told by the data.
+# writes are buffered per process and committed in transactions of BATCHSIZE tiles, flush() commits the rest at the end of a task.
+# reading works whether or not --pack is on, so timelines can mix packed and loose snapshots.
+
+_enabled = False
+_connections = {}
+# with --workers=threads several workers share the module, each thread buffers its own tiles.
+_local = threading.local()
+
+
+
+def configure(mode):
+	global _enabled
+	_enabled = bool(mode) and mode != "false"
+
+
+def enabled():
+	return _enabled
+
+
+def locate(path):
+	rest, name = os.path.split(path)
+	rest, x = os.path.split(rest)
+	folder, z = os.path.split(rest)
+	y, _ = os.path.splitext(name)
+	try:
+		return os.path.join(folder, PACKFILE), int(z), int(x), int(y)
+	except ValueError:
+		# renderboxes and anything else outside the tile tree
+		return None
+
+
+def connect(packPath, create=False):
+	# connections cannot be shared with forked workers or other threads, so they are kept per process and thread.
+	key = (os.getpid(), threading.get_ident(), packPath)
+	if key not in _connections:
+		if not create and not os.path.isfile(packPath):
+			return None
+		db = sqlite3.connect(packPath, timeout=600)
+		db.execute("PRAGMA journal_mode=WAL")
+		db.execute("CREATE TABLE IF NOT EXISTS tiles (z INTEGER, x INTEGER, y INTEGER, data BLOB, PRIMARY KEY (z, x, y)) WITHOUT ROWID")
+		_connections[key] = db
+	return _connections[key]
+
+
+def pending():
+	if not hasattr(_local, "pending"):
+		_local.pending = {}
+	return _local.pending
+
+
+def put(path, data):
+	packPath, z, x, y = locate(path)
+	pending().setdefault(packPath, []).append((z, x, y, data))
+	if len(pending()[packPath]) >= BATCHSIZE:
+		flush(packPath)
+
+
+def flush(packPath=None):
+	for path in [packPath] if packPath is not None else list(pending()):
+		rows = pending().pop(path, [])
+		if len(rows) > 0:
+			db = connect(path, True)
+			with db:
+				db.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", rows)
+
+
+def read(path):
+	location = locate(path)
+	if location is None:
+		return None
+	packPath, z, x, y = location
+	for row in reversed(pending().get(packPath, [])):
+		if row[:3] == (z, x, y):
+			return row[3]
+	db = connect(packPath)
+	if db is None:
+		return None
+	row = db.execute("SELECT data FROM tiles WHERE z = ? AND x = ? AND y = ?", (z, x, y)).fetchone()
+	return row[0] if row is not None else None
+
+
+def exists(path):
+	return os.path.isfile(path) or read(path) is not None
+
+
+def tiles(folder, z):
+	db = connect(os.path.join(folder, PACKFILE))
+	if db is None:
+		return []
+	return db.execute("SELECT x, y FROM tiles WHERE z = ?", (z,)).fetchall()
+
+
+def checkpoint(folder):
+	# moves the write ahead log into the pack itself, so copying tiles.sqlite alone is enough.
+	db = connect(os.path.join(folder, PACKFILE))
+	if db is not None:
+		db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def hasLevel(folder, z):
+	db = connect(os.path.join(folder, PACKFILE))
+	return db is not None and db.execute("SELECT 1 FROM tiles WHERE z = ? LIMIT 1", (z,)).fetchone() is not None
+
+
+
+
+
+def export(*args, **kwargs):
+	"""unpacks all packs of a timeline into the usual <z>/<x>/<y>.<ext> tree, the packs are removed afterwards unless --keep is passed."""
+	from codec import sniffExtension
+
+	toppath = os.path.join((args[1] if len(args) > 1 else "../../script-output/FactorioMaps"), args[0])
+
+	for curdir, _, files in os.walk(os.path.join(toppath, "Images")):
+		if PACKFILE in files:
+			print("unpacking %s" % os.path.relpath(curdir, toppath))
+			db = connect(os.path.join(curdir, PACKFILE))
+			for z, x, y, data in db.execute("SELECT z, x, y, data FROM tiles"):
+				os.makedirs(os.path.join(curdir, str(z), str(x)), exist_ok=True)
+				with open(os.path.join(curdir, str(z), str(x), str(y) + sniffExtension(data)), "wb") as f:
+					f.write(data)
+			db.close()
+			del _connections[(os.getpid(), threading.get_ident(), os.path.join(curdir, PACKFILE))]
+			if not kwargs.get("keep"):
+				for suffix in ("", "-wal", "-shm"):
+					if os.path.isfile(os.path.join(curdir, PACKFILE + suffix)):
+						os.remove(os.path.join(curdir, PACKFILE + suffix))
+
+
+
+
+
+if __name__ == '__main__':
+	export(*[arg for arg in sys.argv[1:] if not arg.startswith("--")], **{arg[2:]: True for arg in sys.argv[1:] if arg.startswith("--")})
@@ -0,0 +1,88 @@
+import threading
+
+
+
+class Pipeline:
+	"""Runs the crop, ref and zoom steps of auto() as a dependency graph against one budget of cores and memory (MiB).
+	A task starts as soon as everything it depends on is done and at least one core is free. It is handed as many of the cores
+	it asks for as are free at that moment, further limited by memoryPerCore. Tasks that ask for no cores (waiting for files) always start.
+	The factorio run takes its cores with reserve(), which never blocks, so new tasks just hold off until the game is closed."""
+
+	def __init__(self, cores, memory):
+		self.freeCores = cores
+		self.freeMemory = memory
+		self.condition = threading.Condition()
+		self.pending = {}
+		self.done = set()
+		self.failed = set()
+		self.errors = []
+		self.running = 0
+
+	def add(self, key, func, after=(), cores=0, memoryPerCore=0):
+		"""func is called with the granted core count."""
+		with self.condition:
+			self.pending[key] = (func, [dependency for dependency in after if dependency is not None], cores, memoryPerCore)
+			self._schedule()
+		return key
+
+	def reserve(self, cores):
+		with self.condition:
+			self.freeCores -= cores
+
+	def release(self, cores):
+		with self.condition:
+			self.freeCores += cores
+			self._schedule()
+
+	def join(self):
+		with self.condition:
+			while self.running > 0:
+				self.condition.wait()
+			if len(self.errors) > 0:
+				raise self.errors[0]
+			if len(self.pending) > 0:
+				raise RuntimeError("tasks %s wait on tasks that were never added" % list(self.pending))
+
+	def _schedule(self):
+		for key, (func, after, cores, memoryPerCore) in list(self.pending.items()):
+			if any(dependency in self.failed for dependency in after):
+				del self.pending[key]
+				self.failed.add(key)
+				continue
+			if not all(dependency in self.done for dependency in after):
+				continue
+			if cores == 0:
+				# reserve() can push freeCores below zero, a task that asks for no cores must not be handed that debt and give it back when it is done.
+				granted = 0
+			else:
+				granted = min(cores, self.freeCores, self.freeMemory // memoryPerCore if memoryPerCore > 0 else cores)
+			if cores > 0 and granted < 1:
+				if self.running > 0 or self.freeCores < 1:
+					continue
+				# a task that needs more memory than the whole budget still has to run at some point.
+				granted = 1
+			del self.pending[key]
+			self.freeCores -= granted
+			self.freeMemory -= granted * memoryPerCore
+			self.running += 1
+			thread = threading.Thread(target=self._run, args=(key, func, granted, memoryPerCore))
+			thread.daemon = True
+			thread.start()
+
+	def _run(self, key, func, granted, memoryPerCore):
+		try:
+			func(granted)
+			error = None
+		except Exception as e:
+			error = e
+		with self.condition:
+			if error is None:
+				self.done.add(key)
+			else:
+				self.failed.add(key)
+				self.errors.append(error)
+			self.freeCores += granted
+			self.freeMemory += granted * memoryPerCore
+			self.running -= 1
+			self._schedule()
+			self.condition.notify_all()
@@ -1,94 +1,220 @@
 import os, sys, math, time, json, psutil
-from PIL import Image, ImageChops, ImageStat
+import numpy
+from PIL import Image
 import multiprocessing as mp
 from functools import partial
 from shutil import get_terminal_size as tsize
 import traceback
 
+import chunks
+import codec
+import owners
+import pack
+import signatures
+import workers
+import writebehind
+from codec import loadTile
+from crop import cropAll, isWritten
+from zoom import saveScreenshot
 
 
 ext = ".png"
-outext = ".jpg"
 
 
 
-def test(paths):
-	newImg = Image.open(paths[0], mode='r').convert("RGB")
-	oldImg = Image.open(paths[1], mode='r').convert("RGB")
-	treshold = .03 * newImg.size[0]**2
+COMPAREBATCH = 32
+# grid cells per image above which neighbourScan looks the neighbours up one by one, far apart outposts would make the dense grid huge.
+DENSEGRIDCELLS = 16
+
+
+def signature(img):
 	# jpeg artifacts always average out perfectly over 8x8 sections, we take advantage of that and scale down by 8 so we can compare compressed images with uncompressed images.
-	size = (newImg.size[0] / 8, newImg.size[0] / 8)
-	newImg.thumbnail(size, Image.BILINEAR)
-	oldImg.thumbnail(size, Image.BILINEAR)
-	diff = ImageChops.difference(newImg, oldImg)
-	return sum(ImageStat.Stat(diff).sum2) > treshold
+	arr = numpy.asarray(img)
+	h, w = arr.shape[0] // 8, arr.shape[1] // 8
+	# the block sums are kept instead of the means, they fit in 16 bits and do not lose precision to rounding.
+	return arr[:h*8, :w*8].reshape(h, 8, w, 8, 3).sum(axis=(1, 3), dtype=numpy.uint16)
 
+def testBatch(newSigs, oldSigs, tresholds):
+	if all(sig.shape == newSigs[0].shape for sig in newSigs + oldSigs):
+		diff = (numpy.stack(newSigs).astype(numpy.float32) - numpy.stack(oldSigs)) / 64
+		return (diff * diff).reshape(len(newSigs), -1).sum(axis=1) > numpy.array(tresholds)
+	return [testBatch([new], [old], [treshold])[0] for new, old, treshold in zip(newSigs, oldSigs, tresholds)]
 
-def compare(path, basePath, new, progressQueue):
-	testResult = False
+def test(paths):
+	return testImages(Image.open(paths[0], mode='r').convert("RGB"), Image.open(paths[1], mode='r').convert("RGB"))
+
+def testImages(newImg, oldImg):
+	return testBatch([signature(newImg)], [signature(oldImg)], [.03 * newImg.size[0]**2])[0]
+
+
+def scaledSignature(path):
+	# the 1/8 scaled jpeg decode already is the 8x8 block mean.
+	return loadTile(path, 8).astype(numpy.uint16) * 64
+
+def oldSignature(basePath, path):
+	sig = signatures.lookup(signatures.cachedStore(os.path.join(basePath, *path[:3], signatures.SIGNATUREFILE)), path[4], os.path.splitext(path[5])[0])
+	if sig is None:
+		sig = scaledSignature(codec.tileFile(os.path.splitext(os.path.join(basePath, *path))[0], int(path[3])))
+	return sig
+
+def newStore(stores, basePath, new, path):
+	storePath = os.path.join(basePath, new, path[1], path[2], signatures.SIGNATUREFILE + ".tmp")
+	if storePath not in stores:
+		stores[storePath] = signatures.openStore(storePath, "r+")[1]
+	return stores[storePath]
+
+
+def compare(batch, basePath, new):
+	stores = {}
+	newSigs, oldSigs, tresholds, compared = [], [], [], []
+	testResults = [True] * len(batch)
+	try:
+		for i, (row, path, _) in enumerate(batch):
+			newImg = Image.open(os.path.join(basePath, new, *path[1:]), mode='r').convert("RGB")
+			newSig = signature(newImg)
+			newStore(stores, basePath, new, path)[row] = newSig
+			if path[0] is not None:
+				compared.append(i)
+				newSigs.append(newSig)
+				oldSigs.append(oldSignature(basePath, path))
+				tresholds.append(.03 * newImg.size[0]**2)
+		if len(compared) > 0:
+			for i, testResult in zip(compared, testBatch(newSigs, oldSigs, tresholds)):
+				testResults[i] = bool(testResult)
+		for store in stores.values():
+			store.flush()
+	except:
+		print("\r")
+		traceback.print_exc()
+		print("\n")
+		raise
+	return [(testResult, item[1][1:]) for testResult, item in zip(testResults, batch)]
+
+def fuse(batch, basePath, new):
+	# the fused pipeline decodes the raw screenshot once, crops it in memory, compares it and only encodes it when it is kept.
+	# returns the results, and the items whose screenshot the game has not finished writing yet.
+	results = []
+	retry = []
+	for item in batch:
+		result = fuseItem(item, basePath, new)
+		if result is None:
+			retry.append(item)
+		else:
+			results.append(result)
+	pack.flush()
+	writebehind.flush()
+	return results, retry
+
+def fuseAll(pool, items, basePath, new, maxthreads, progress=None):
+	# done.txt can show up while the game is still writing screenshots in the background, those are retried like crop() does.
+	results = []
+	while len(items) > 0:
+		batches = workers.runBatches(pool, partial(fuse, basePath=basePath, new=new), [items[i:i+pack.BATCHSIZE] for i in range(0, len(items), pack.BATCHSIZE)], maxthreads, progress)
+		results += [result for done, _ in batches for result in done]
+		items = [item for _, retry in batches for item in retry]
+		if len(items) > 0:
+			time.sleep(10 if len(items) > 1000 else 1)
+	return results
+
+def fuseItem(item, basePath, new):
+	row, path, box = item
+	newPath = os.path.join(basePath, new, *path[1:])
+	testResult = True
 	try:
-		testResult = test((os.path.join(basePath, new, *path[1:]), os.path.join(basePath, *path).replace(ext, outext)))
+		# the size was just read, so this only checks that the png trailer is there.
+		if not isWritten(newPath, os.path.getsize(newPath))[0]:
+			return None
+		img = numpy.asarray(Image.open(newPath, mode='r').convert("RGB"))
+	except IOError:
+		return None
+	try:
+		if box is not None:
+			# a view, it is only copied when the encoder needs it contiguous.
+			img = img[box[1]:box[3], box[0]:box[2]]
+		if row is not None:
+			stores = {}
+			newSig = signature(img)
+			newStore(stores, basePath, new, path)[row] = newSig
+			stores.popitem()[1].flush()
+			if path[0] is not None:
+				testResult = bool(testBatch([newSig], [oldSignature(basePath, path)], [.03 * img.shape[1]**2])[0])
+		if testResult:
+			saveScreenshot(img, os.path.splitext(newPath)[0], int(path[3]))
 	except:
 		print("\r")
 		traceback.print_exc()
 		print("\n")
 		raise
-	finally:
-		progressQueue.put(True, True)
 	return (testResult, path[1:])
 
 def compare_renderbox(renderbox, basePath, new):
 	newPath = os.path.join(basePath, new, renderbox[0]) + ext
 	testResult = False
 	try:
-		testResult = test((newPath, os.path.join(basePath, renderbox[1], renderbox[0]) + outext))
+		testResult = test((newPath, codec.tileFile(os.path.join(basePath, renderbox[1], renderbox[0]), int(os.path.basename(os.path.dirname(renderbox[0]))))))
 	except:
 		print("\r")
 		raise
 	return (testResult, newPath, renderbox[1], renderbox[2])
 
 
-def neighbourScan(coord, keepList, cropList):
+NEIGHBOURS = (
+	# (dx, dy, corner bits of the neighbour that reach into this image)
+	( 1,  1, 0b1000),
+	( 1, -1, 0b0100),
+	(-1,  1, 0b0010),
+	(-1, -1, 0b0001),
+	( 1,  0, 0b1100),
+	(-1,  0, 0b0011),
+	( 0,  1, 0b1010),
+	( 0, -1, 0b0101),
+)
+
+def neighbourScan(candidates, keepList, cropList):
 		"""
 		x+ = UP, y+ = RIGHT
 		corners:
 		2   1
 		X
 		4   3
+		returns for every candidate if a kept neighbour was cropped into it.
 		"""
-		surfaceName, daytime, z = coord[:3]
-		x, y = int(coord[3]), int(os.path.splitext(coord[4])[0])
-		return (((surfaceName, daytime, z, str(x+1), str(y+1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x+1, y+1), 0) & 0b1000) \
-			or ((surfaceName, daytime, z, str(x+1), str(y-1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x+1, y-1), 0) & 0b0100) \
-			or ((surfaceName, daytime, z, str(x-1), str(y+1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x-1, y+1), 0) & 0b0010) \
-			or ((surfaceName, daytime, z, str(x-1), str(y-1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x-1, y-1), 0) & 0b0001) \
-			or ((surfaceName, daytime, z, str(x+1), str(y  ) + ext) in keepList and cropList.get((surfaceName, daytime, z, x+1, y  ), 0) & 0b1100) \
-			or ((surfaceName, daytime, z, str(x-1), str(y  ) + ext) in keepList and cropList.get((surfaceName, daytime, z, x-1, y  ), 0) & 0b0011) \
-			or ((surfaceName, daytime, z, str(x  ), str(y+1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x  , y+1), 0) & 0b1010) \
-			or ((surfaceName, daytime, z, str(x  ), str(y-1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x  , y-1), 0) & 0b0101), coord)
-
-
-
+		keepByLayer = {}
+		for coord in keepList:
+			keepByLayer.setdefault(tuple(coord[:3]), []).append((int(coord[3]), int(os.path.splitext(coord[4])[0])))
+		candidatesByLayer = {}
+		for i, coord in enumerate(candidates):
+			candidatesByLayer.setdefault(tuple(coord[:3]), []).append((i, int(coord[3]), int(os.path.splitext(coord[4])[0])))
 
+		result = [False] * len(candidates)
+		for layer, layerCandidates in candidatesByLayer.items():
+			kept = [(x, y, cropList.get((*layer, x, y), 0)) for x, y in keepByLayer.get(layer, [])]
+			kept = numpy.array([k for k in kept if k[2]], dtype=numpy.int64).reshape(-1, 3)
+			if len(kept) == 0:
+				continue
+			layerCandidates = numpy.array(layerCandidates, dtype=numpy.int64)
 
+			# dense grid over the bounding box with a border of one, so the shifts below never wrap real images around.
+			minX = min(kept[:, 0].min(), layerCandidates[:, 1].min()) - 1
+			minY = min(kept[:, 1].min(), layerCandidates[:, 2].min()) - 1
+			maxX = max(kept[:, 0].max(), layerCandidates[:, 1].max()) + 1
+			maxY = max(kept[:, 1].max(), layerCandidates[:, 2].max()) + 1
+			if (maxX - minX + 1) * (maxY - minY + 1) > DENSEGRIDCELLS * (len(kept) + len(layerCandidates)):
+				keptCorners = {(x, y): bits for x, y, bits in kept.tolist()}
+				for i, x, y in layerCandidates.tolist():
+					result[i] = any(keptCorners.get((x + dx, y + dy), 0) & bits != 0 for dx, dy, bits in NEIGHBOURS)
+				continue
 
+			corners = numpy.zeros((maxX - minX + 1, maxY - minY + 1), dtype=numpy.uint8)
+			corners[kept[:, 0] - minX, kept[:, 1] - minY] = kept[:, 2]
 
-def base64Char(i):
-	assert(i >= 0 and i < 64) # Did you change image size? it could make this overflow
-	if i == 63:
-		return "/"
-	elif i == 62:
-		return "+"
-	elif i > 51:
-		return chr(i - 4)
-	elif i > 25:
-		return chr(i + 71)
-	return chr(i + 65)
-def getBase64(number, isNight): #coordinate to 18 bit value (3 char base64)
-	number = int(number) + (2**16 if isNight else (2**17 + 2**16)) # IMAGES CURRENTLY CONTAIN 16 TILES. IF IMAGE SIZE CHANGES THIS WONT WORK ANYMORE. (It will for a long time until it wont)
-	return base64Char(number % 64) + base64Char(int(number / 64) % 64) + base64Char(int(number / 64 / 64))
-
+			retained = numpy.zeros(corners.shape, dtype=bool)
+			for dx, dy, bits in NEIGHBOURS:
+				retained |= numpy.roll(corners & bits != 0, (-dx, -dy), axis=(0, 1))
 
+			for i, isRetained in zip(layerCandidates[:, 0], retained[layerCandidates[:, 1] - minX, layerCandidates[:, 2] - minY]):
+				result[i] = bool(isRetained)
+		return result
 
 
 
@@ -104,10 +230,12 @@ def ref(*args, **kwargs):
 	toppath = os.path.join((args[4] if len(args) > 4 else "../../script-output/FactorioMaps"), args[0])
 	datapath = os.path.join(toppath, "mapInfo.json")
 	maxthreads = int(kwargs["refthreads" if kwargs["refthreads"] else"maxthreads"])
+	fused = kwargs.get("fused")
+	workers.configure(toppath, kwargs)
 
 
 
-	pool = mp.Pool(processes=maxthreads)
+	pool = workers.acquire(maxthreads, toppath, kwargs)
 
 	with open(datapath, "r") as f:
 		data = json.load(f)
@@ -136,6 +264,14 @@ def ref(*args, **kwargs):
 
 
 	newMap = data["maps"][new]
+
+	# the viewer builds the tile urls of a snapshot from the extension of every zoom level.
+	extensions = outdata["maps"][str(new)].setdefault("extensions", {})
+	for surface in newMap["surfaces"].values():
+		for z in range(surface["zoom"]["min"], surface["zoom"]["max"] + 1):
+			if extensions.get(str(z)) != codec.extension(z):
+				extensions[str(z)] = codec.extension(z)
+				changed = True
 	allImageIndex = {}
 	allDayImages = {}
 
@@ -145,6 +281,9 @@ def ref(*args, **kwargs):
 		keepList = []
 		firstRemoveList = []
 		cropList = {}
+		cropBoxes = {}
+		renderboxCropLines = []
+		ownerIndexes = {}
 		didAnything = False
 		if len(args) <= 3 or daytime == args[3]:
 			for surfaceName, surface in newMap["surfaces"].items():
@@ -153,7 +292,7 @@ def ref(*args, **kwargs):
 					z = surface["zoom"]["max"]
 
 
-					dayImages = []
+					dayImages = set()
 
 					newComparedSurfaces.append((surfaceName, daytime))
 					
@@ -173,11 +312,11 @@ def ref(*args, **kwargs):
 									value = split[4]
 								else:
 									split = line.rstrip("\n").split(" ", 5)
-									pathSplit = split[5].split("/", 2)
-									if pathSplit[0] != str(z):
+									pathSplit = split[5].rsplit("/", 3)
+									if pathSplit[1] != str(z):
 										continue
-									key = (surfaceName, daytime, str(z), int(pathSplit[1]), int(os.path.splitext(pathSplit[2])[0]))
-									value = split[2]
+									key = (surfaceName, daytime, str(z), int(pathSplit[2]), int(os.path.splitext(pathSplit[3])[0]))
+									value = split[4]
 								
 								cropList[key] = int(value, 16) | cropList.get(key, 0) if combinePrevious else int(value, 16)
 
@@ -186,17 +325,42 @@ def ref(*args, **kwargs):
 								
 					readCropList(os.path.join(toppath, "Images", newMap["path"], surfaceName, daytime, "crop.txt"), True)
 
+					if fused:
+						# crop.py did not run, so the crop rectangles are applied in memory by fuse(). renderboxes are cropped in place.
+						tilePrefix = "/".join((newMap["path"], surfaceName, daytime, str(z))) + "/"
+						with open(os.path.join(toppath, "Images", newMap["path"], surfaceName, daytime, "crop.txt"), "r") as f:
+							assert(f.readline().rstrip('\n') == "v2")
+							for line in f:
+								split = line.rstrip("\n").split(" ", 5)
+								if split[5].startswith(tilePrefix):
+									top, left, width, height = map(int, split[:4])
+									cropBoxes[split[5]] = (top, left, top + width, left + height)
+								else:
+									renderboxCropLines.append(line)
+
 
 
 					oldImages = {}
-					for old in oldMapsList:
-						if surfaceName in data["maps"][old]["surfaces"] and daytime in surface and z == surface["zoom"]["max"]:
-							if surfaceName not in allImageIndex:
-								allImageIndex[surfaceName] = {}
+					ownerIndex = None
+					if len(oldMapsList) > 0:
+						if surfaceName not in allImageIndex:
+							allImageIndex[surfaceName] = {}
+						ownerIndex = owners.load(os.path.join(toppath, "Images", data["maps"][oldMapsList[-1]]["path"], surfaceName, daytime, owners.OWNERFILE))
+					if ownerIndex is not None and ownerIndex[0] == z:
+						ownerIndex = owners.toDict(ownerIndex)
+					else:
+						# no owner index from the previous snapshot (yet), find the owners by scanning all older snapshots once.
+						ownerIndex = {}
+						for old in oldMapsList:
 							path = os.path.join(toppath, "Images", data["maps"][old]["path"], surfaceName, daytime, str(z))
-							for x in os.listdir(path):
+							for x in os.listdir(path) if os.path.isdir(path) else []:
 								for y in os.listdir(os.path.join(path, x)):
-									oldImages[(x, y.replace(ext, outext))] = data["maps"][old]["path"]
+									ownerIndex[(int(x), int(os.path.splitext(y)[0]))] = old
+							for x, y in pack.tiles(os.path.dirname(path), z):
+								ownerIndex[(x, y)] = old
+					for (x, y), old in ownerIndex.items():
+						oldImages[(str(x), str(y))] = data["maps"][old]["path"]
+					ownerIndexes[surfaceName] = ownerIndex
 
 					if daytime != "day":
 						if not os.path.isfile(os.path.join(toppath, "Images", newMap["path"], surfaceName, "day", "ref.txt")):
@@ -206,7 +370,7 @@ def ref(*args, **kwargs):
 							
 							with open(os.path.join(toppath, "Images", newMap["path"], surfaceName, "day", "ref.txt"), "r") as f:
 								for line in f:
-									dayImages.append(tuple(line.rstrip("\n").split(" ", 2)))
+									dayImages.add(tuple(line.rstrip("\n").split(" ", 2)))
 									
 
 						allDayImages[surfaceName] = dayImages
@@ -215,10 +379,10 @@ def ref(*args, **kwargs):
 					path = os.path.join(toppath, "Images", newMap["path"], surfaceName, daytime, str(z))
 					for x in os.listdir(path):
 						for y in os.listdir(os.path.join(path, x)):
-							if (x, os.path.splitext(y)[0]) in dayImages or (x, y.replace(ext, outext)) not in oldImages:
+							if (x, os.path.splitext(y)[0]) in dayImages or (x, os.path.splitext(y)[0]) not in oldImages:
 								keepList.append((surfaceName, daytime, str(z), x, y))
-							elif (x, y.replace(ext, outext)) in oldImages:
-								compareList.append((oldImages[(x, y.replace(ext, outext))], surfaceName, daytime, str(z), x, y))
+							else:
+								compareList.append((oldImages[(x, os.path.splitext(y)[0])], surfaceName, daytime, str(z), x, y))
 
 			   
 
@@ -230,48 +394,73 @@ def ref(*args, **kwargs):
 	
 
 		if kwargs["verbose"]: print("found %s new images" % len(keepList))
-		if len(compareList) > 0:
+		if len(renderboxCropLines) > 0:
+			if kwargs["verbose"]: print("cropping %s renderboxes" % len(renderboxCropLines))
+			workers.runBatches(pool, partial(cropAll, folder=os.path.join(toppath, "Images")), [renderboxCropLines[i:i+16] for i in range(0, len(renderboxCropLines), 16)], maxthreads)
+
+		# new images are passed trough the workers too, so the signatures of every image of this snapshot end up in its signature file.
+		workList = []
+		pathsBySurface = {}
+		for path in [(None, *coord) for coord in keepList] + compareList:
+			pathsBySurface.setdefault(path[1], []).append(path)
+		for surfaceName, paths in pathsBySurface.items():
+			folder = os.path.join(toppath, "Images", newMap["path"], surfaceName, daytime)
+			boxes = [cropBoxes.get("/".join((newMap["path"], *path[1:]))) for path in paths]
+			size = boxes[0][2] - boxes[0][0] if boxes[0] else Image.open(os.path.join(folder, *paths[0][3:])).size[0]
+			rows = signatures.create(os.path.join(folder, signatures.SIGNATUREFILE + ".tmp"), [(int(path[4]), int(os.path.splitext(path[5])[0])) for path in paths], (size // 8, size // 8, 3))
+			workList += zip(rows, paths, boxes)
+		keepList = []
+		if len(workList) > 0:
 			if kwargs["verbose"]: print("comparing %s existing images" % len(compareList))
-			m = mp.Manager()
-			progressQueue = m.Queue()
-			#compare(compareList[0], treshold=treshold, basePath=os.path.join(toppath, "Images"), new=str(newMap["path"]), progressQueue=progressQueue)
-			workers = pool.map_async(partial(compare, basePath=os.path.join(toppath, "Images"), new=str(newMap["path"]), progressQueue=progressQueue), compareList, 128)
 			doneSize = 0
-			print("ref  {:5.1f}% [{}]".format(0, " " * (tsize()[0]-15)), end="")
-			for i in range(len(compareList)):
-				progressQueue.get(True)
-				doneSize += 1
-				progress = float(doneSize) / len(compareList)
+			def printProgress(results):
+				nonlocal doneSize
+				doneSize += len(results[0] if fused else results)
+				progress = float(doneSize) / len(workList)
 				tsiz = tsize()[0]-15
 				print("\rref  {:5.1f}% [{}{}]".format(round(progress * 100, 1), "=" * int(progress * tsiz), " " * (tsiz - int(progress * tsiz))), end="")
-			workers.wait()
-			resultList = workers.get()
+			print("ref  {:5.1f}% [{}]".format(0, " " * (tsize()[0]-15)), end="")
+			#compare(compareList[0], treshold=treshold, basePath=os.path.join(toppath, "Images"), new=str(newMap["path"]))
+			if fused:
+				resultList = fuseAll(pool, workList, os.path.join(toppath, "Images"), str(newMap["path"]), maxthreads, printProgress)
+			else:
+				batches = workers.runBatches(pool, partial(compare, basePath=os.path.join(toppath, "Images"), new=str(newMap["path"])), [workList[i:i+COMPAREBATCH] for i in range(0, len(workList), COMPAREBATCH)], maxthreads, printProgress)
+				resultList = [result for batch in batches for result in batch]
 
 			newList = [x[1] for x in [x for x in resultList if x[0]]]
 			firstRemoveList += [x[1] for x in [x for x in resultList if not x[0]]]
-			if kwargs["verbose"]: print("found %s changed in %s images" % (len(newList), len(compareList)))
+			if kwargs["verbose"]: print("found %s changed in %s images" % (len(newList) - len(workList) + len(compareList), len(compareList)))
 			keepList += newList
 			print("\rref  {:5.1f}% [{}]".format(100, "=" * (tsize()[0]-15)))
 		
 
 		if kwargs["verbose"]: print("scanning %s chunks for neighbour cropping" % len(firstRemoveList))
-		resultList = pool.map(partial(neighbourScan, keepList=keepList, cropList=cropList), firstRemoveList, 64)
-		neighbourList = [x[1] for x in [x for x in resultList if x[0]]]
-		removeList = [x[1] for x in [x for x in resultList if not x[0]]]
+		resultList = neighbourScan(firstRemoveList, keepList, cropList)
+		neighbourList = [coord for coord, isRetained in zip(firstRemoveList, resultList) if isRetained]
+		removeList = [coord for coord, isRetained in zip(firstRemoveList, resultList) if not isRetained]
 		if kwargs["verbose"]: print("keeping %s neighbouring images" % len(neighbourList))
+		if fused and len(neighbourList) > 0:
+			neighbourWork = [(None, (None, *coord), cropBoxes.get("/".join((newMap["path"], *coord)))) for coord in neighbourList]
+			fuseAll(pool, neighbourWork, os.path.join(toppath, "Images"), str(newMap["path"]), maxthreads)
 
 
 		if kwargs["verbose"]: print("deleting %s, keeping %s of %s existing images" % (len(removeList), len(keepList) + len(neighbourList), len(keepList) + len(neighbourList) + len(removeList)))
 
 
 		if kwargs["verbose"]: print("removing identical images")
-		for x in removeList:
-			os.remove(os.path.join(toppath, "Images", newMap["path"], *x))
+		writebehind.removeAll([os.path.join(toppath, "Images", newMap["path"], *x) for x in removeList])
 
 
 		if kwargs["verbose"]: print("creating render index")
 		for surfaceName, daytime in newComparedSurfaces:
-			z = surface["zoom"]["max"]
+			z = newMap["surfaces"][surfaceName]["zoom"]["max"]
+			folder = os.path.join(toppath, "Images", newMap["path"], surfaceName, daytime)
+			keptCoords = [(int(coord[3]), int(os.path.splitext(coord[4])[0])) for coord in keepList + neighbourList if coord[0] == surfaceName and coord[1] == daytime]
+			signatures.compact(os.path.join(folder, signatures.SIGNATUREFILE + ".tmp"), os.path.join(folder, signatures.SIGNATUREFILE), keptCoords)
+			ownerIndex = ownerIndexes[surfaceName]
+			for coord in keptCoords:
+				ownerIndex[coord] = new
+			owners.save(os.path.join(folder, owners.OWNERFILE), z, ownerIndex)
 			with open(os.path.join(toppath, "Images", newMap["path"], surfaceName, daytime, "ref.txt"), "w") as f:
 				for aList in (keepList, neighbourList):
 					for coord in aList:
@@ -291,9 +480,8 @@ def ref(*args, **kwargs):
 				if coord[1] not in allImageIndex[coord[0]]:
 					allImageIndex[coord[0]][coord[1]] = {}
 				if y not in allImageIndex[coord[0]][coord[1]]:
-					allImageIndex[coord[0]][coord[1]][y] = [x]
-				elif x not in allImageIndex[coord[0]][coord[1]][y]:
-					allImageIndex[coord[0]][coord[1]][y].append(x)
+					allImageIndex[coord[0]][coord[1]][y] = set()
+				allImageIndex[coord[0]][coord[1]][y].add(x)
 
 
 					
@@ -344,7 +532,7 @@ def ref(*args, **kwargs):
 			count = 0
 			for (isDifferent, path, oldPath, links) in resultList:
 				if not isDifferent:
-					os.remove(path)
+					writebehind.remove(path)
 
 					for (surfaceName, linkIndex) in links:
 						outdata["maps"][str(new)]["surfaces"][surfaceName]["links"][linkIndex] = { "path": oldPath }
@@ -363,45 +551,40 @@ def ref(*args, **kwargs):
 
 
 
-	# compress and build string
+	# compress and write the client index
 	for surfaceName, daytimeImageIndex in allImageIndex.items():
-		indexList = []
 		daytime = "night" if "night" in daytimeImageIndex and data["maps"][new]["surfaces"][surfaceName] and str(data["maps"][new]["surfaces"][surfaceName]["night"]) else "day"
-		surfaceImageIndex = daytimeImageIndex[daytime]
-		for y, xList in surfaceImageIndex.items():
-			string = getBase64(y, False)
-			isLastChangedImage = False
-			isLastNightImage = False
-			
-			for x in range(min(xList), max(xList) + 2):
-				isChangedImage = x in xList                                                             #does the image exist at all? 
-				isNightImage = daytime == "night" and (str(x), str(y)) not in allDayImages[surfaceName] #is this image only in night?
-				if isLastChangedImage != isChangedImage or (isChangedImage and isLastNightImage != isNightImage): #differential encoding
-					string += getBase64(x, isNightImage if isChangedImage else isLastNightImage)
-					isLastChangedImage = isChangedImage
-					isLastNightImage = isNightImage
-			indexList.append(string)
+		dayImages = allDayImages.get(surfaceName, set())
+		rows = {}
+		for y, xList in daytimeImageIndex[daytime].items():
+			rows[y] = chunks.runs(sorted(xList), lambda x: daytime != "night" or (str(x), str(y)) in dayImages) #is this image also in day?
+		chunks.save(os.path.join(toppath, "Images", newMap["path"], surfaceName, chunks.CHUNKFILE), rows)
 			
 			
 		if surfaceName not in outdata["maps"][str(new)]["surfaces"]:
 			outdata["maps"][str(new)]["surfaces"][surfaceName] = {}
-		outdata["maps"][str(new)]["surfaces"][surfaceName]["chunks"] = '='.join(indexList)
-		if len(indexList) > 0:
+		outdata["maps"][str(new)]["surfaces"][surfaceName]["chunkIndex"] = "/".join(("Images", newMap["path"], surfaceName, chunks.CHUNKFILE))
+		if len(rows) > 0:
 			changed = True
 			
 
 
 
+	# the deletions are queued whether or not anything changed, their errors are raised here.
+	stats = writebehind.flush()
+	if kwargs["verbose"]: print(writebehind.describe(stats))
+
 	if changed:
 		if kwargs["verbose"]: print("writing mapInfo.out.json")
 		with open(datapath[:-5] + ".out.json", "w+") as f:
 			json.dump(outdata, f)
 
 		if kwargs["verbose"]: print("deleting empty folders")
-		for curdir, subdirs, files in os.walk(toppath, *args[1:4]):
+		for curdir, subdirs, files in os.walk(os.path.join(toppath, "Images", *args[1:4])):
 			if len(subdirs) == 0 and len(files) == 0:
 				os.rmdir(curdir)
 
+	workers.release(pool)
 
 		
 
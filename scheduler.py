@@ -0,0 +1,50 @@
+import queue
+from collections import deque
+
+
+
+class Scheduler:
+	"""Runs tasks on a multiprocessing pool as soon as every task they depend on has finished.
+	Idle workers take whatever task is ready next from the pool's shared queue, run() returns what every task returned by key. Only a few tasks are queued per worker at a time,
+	and the most recently readied task goes first, so a subtree that can be finished is finished before new ones are started."""
+
+	def __init__(self, pool, workers):
+		self.pool = pool
+		self.maxPending = 2 * workers
+		self.tasks = {}
+		self.waiting = {}
+		self.dependents = {}
+
+	def add(self, key, func, args=(), after=()):
+		self.tasks[key] = (func, args)
+		self.waiting[key] = len(after)
+		for dependency in after:
+			self.dependents.setdefault(dependency, []).append(key)
+
+	def run(self, progress=None):
+		done = queue.Queue()
+		results = {}
+		ready = deque(key for key, count in self.waiting.items() if count == 0)
+		pending = 0
+		finished = 0
+		while finished < len(self.tasks):
+			while len(ready) > 0 and pending < self.maxPending:
+				key = ready.pop()
+				func, args = self.tasks[key]
+				self.pool.apply_async(func, args, callback=lambda result, key=key: done.put((key, result, None)), error_callback=lambda e, key=key: done.put((key, None, e)))
+				pending += 1
+			if pending == 0:
+				raise RuntimeError("%s tasks wait on tasks that were never added" % (len(self.tasks) - finished))
+
+			key, results[key], error = done.get()
+			if error is not None:
+				raise error
+			pending -= 1
+			finished += 1
+			for dependent in self.dependents.get(key, ()):
+				self.waiting[dependent] -= 1
+				if self.waiting[dependent] == 0:
+					ready.append(dependent)
+			if progress is not None:
+				progress(finished, len(self.tasks))
+		return results
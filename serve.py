@@ -0,0 +1,43 @@
+import os, sys
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pack
+
+
+
+class PackRequestHandler(SimpleHTTPRequestHandler):
+	"""serves a map folder like any static file server, tiles that are not on disk are looked up in the packs."""
+
+	def do_GET(self):
+		path = self.translate_path(self.path)
+		if not os.path.exists(path):
+			data = pack.read(path)
+			if data is not None:
+				self.send_response(200)
+				self.send_header("Content-Type", self.guess_type(path))
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+				return
+		super().do_GET()
+
+
+
+def serve(*args, **kwargs):
+	"""serves the output folder of a timeline on http://localhost:<port>, default 8000, so the viewer can load tiles from packs."""
+
+	toppath = os.path.abspath(os.path.join((args[1] if len(args) > 1 else "../../script-output/FactorioMaps"), args[0]))
+	port = int(kwargs.get("port") or 8000)
+
+	server = ThreadingHTTPServer(("localhost", port), partial(PackRequestHandler, directory=toppath))
+	print("serving %s on http://localhost:%s" % (toppath, port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+
+if __name__ == '__main__':
+	serve(*[arg for arg in sys.argv[1:] if not arg.startswith("--")], **dict((arg[2:].split("=", 1) + [True])[:2] for arg in sys.argv[1:] if arg.startswith("--")))
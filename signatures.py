@@ -0,0 +1,156 @@
+import os, sys, json, psutil, threading
+import numpy
+import multiprocessing as mp
+from functools import partial
+
+import codec
+import pack
+from codec import loadTile
+
+
+
+SIGNATUREFILE = "ref.sig"
+MAGIC = b"FMSIG\x00\x00\x01"
+HEADERSIZE = 32
+BATCHSIZE = 64
+
+# stores the downsampled tile signatures of one surface/daytime of one snapshot so later snapshots can compare against them without decoding the old jpg.
+# layout: header, sorted int64 (x, y) keys, uint16 8x8 block sums of every tile in the same order.
+
+OPENSTORES = 64
+_openStores = {}
+_lock = threading.Lock()
+
+
+
+def key(x, y):
+	return (int(x) << 32) | (int(y) & 0xffffffff)
+
+
+def create(path, coords, shape):
+	keys = numpy.array(sorted(set(key(x, y) for x, y in coords)), dtype=numpy.int64)
+	with open(path, "wb") as f:
+		f.write(MAGIC + numpy.array((len(keys), *shape[:2]), dtype=numpy.uint32).tobytes())
+		f.write(b"\0" * (HEADERSIZE - f.tell()))
+		f.write(keys.tobytes())
+		f.truncate(HEADERSIZE + keys.nbytes + len(keys) * int(numpy.prod(shape)) * 2)
+	rows = {}
+	for i, k in enumerate(keys.tolist()):
+		rows[k] = i
+	return [rows[key(x, y)] for x, y in coords]
+
+
+def openStore(path, mode="r"):
+	try:
+		with open(path, "rb") as f:
+			header = f.read(HEADERSIZE)
+	except FileNotFoundError:
+		return None
+	if header[:len(MAGIC)] != MAGIC:
+		return None
+	count, h, w = numpy.frombuffer(header, dtype=numpy.uint32, count=3, offset=len(MAGIC)).tolist()
+	if count == 0:
+		return numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, h, w, 3), dtype=numpy.uint16)
+	keys = numpy.memmap(path, dtype=numpy.int64, mode="r", offset=HEADERSIZE, shape=(count,))
+	data = numpy.memmap(path, dtype=numpy.uint16, mode=mode, offset=HEADERSIZE + count * 8, shape=(count, h, w, 3))
+	return keys, data
+
+
+def cachedStore(path):
+	# a missing file is not remembered, a long lived worker may be asked again once ref wrote it.
+	with _lock:
+		if _openStores.get(path) is None:
+			while len(_openStores) >= OPENSTORES:
+				del _openStores[next(iter(_openStores))]
+			_openStores[path] = openStore(path)
+		return _openStores[path]
+
+
+def lookup(store, x, y):
+	if store is None:
+		return None
+	keys, data = store
+	k = key(x, y)
+	i = numpy.searchsorted(keys, k)
+	if i < len(keys) and keys[i] == k:
+		return numpy.array(data[i])
+	return None
+
+
+def compact(srcPath, destPath, coords):
+	store = openStore(srcPath)
+	if store is None:
+		return
+	keys, data = store
+	keepKeys = numpy.array(sorted(set(key(x, y) for x, y in coords)), dtype=numpy.int64)
+	rows = numpy.searchsorted(keys, keepKeys)
+	with open(destPath, "wb") as f:
+		f.write(MAGIC + numpy.array((len(keepKeys), *data.shape[1:3]), dtype=numpy.uint32).tobytes())
+		f.write(b"\0" * (HEADERSIZE - f.tell()))
+		f.write(keepKeys.tobytes())
+		for i in range(0, len(rows), BATCHSIZE):
+			f.write(numpy.ascontiguousarray(data[rows[i:i+BATCHSIZE]]).tobytes())
+	del keys, data, store
+	os.remove(srcPath)
+
+
+
+
+
+
+
+def rebuildWork(batch, storePath):
+	from ref import scaledSignature
+	store = openStore(storePath, "r+")
+	for row, path in batch:
+		store[1][row] = scaledSignature(path)
+	store[1].flush()
+	return len(batch)
+
+
+def rebuild(*args, **kwargs):
+	"""rebuilds the signature files of an existing timeline from its jpg tiles."""
+
+	psutil.Process(os.getpid()).nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == 'nt' else 10)
+
+	toppath = os.path.join((args[1] if len(args) > 1 else "../../script-output/FactorioMaps"), args[0])
+	basepath = os.path.join(toppath, "Images")
+	maxthreads = int(kwargs.get("maxthreads") or mp.cpu_count())
+
+	with open(os.path.join(toppath, "mapInfo.json"), "r") as f:
+		data = json.load(f)
+
+	with mp.Pool(processes=maxthreads) as pool:
+		for mapObj in data["maps"]:
+			for surfaceName, surface in mapObj["surfaces"].items():
+				for daytime in ("day", "night"):
+					folder = os.path.join(basepath, mapObj["path"], surfaceName, daytime)
+					if not os.path.isfile(os.path.join(folder, "ref.txt")):
+						continue
+					z = surface["zoom"]["max"]
+					coords = []
+					paths = []
+					with open(os.path.join(folder, "ref.txt"), "r") as f:
+						for line in f:
+							x, y = line.rstrip("\n").split(" ", 2)[:2]
+							path = codec.tileFile(os.path.join(folder, str(z), x, y), z)
+							if path is not None:
+								coords.append((int(x), int(y)))
+								paths.append(path)
+					if len(coords) == 0:
+						continue
+
+					print("rebuilding signatures of %s %s %s (%s tiles)" % (mapObj["path"], surfaceName, daytime, len(coords)))
+					size = loadTile(paths[0]).shape[1]
+					storePath = os.path.join(folder, SIGNATUREFILE)
+					rows = create(storePath + ".tmp", coords, (size // 8, size // 8, 3))
+					workList = list(zip(rows, paths))
+					pool.map(partial(rebuildWork, storePath=storePath + ".tmp"), [workList[i:i+BATCHSIZE] for i in range(0, len(workList), BATCHSIZE)])
+					os.replace(storePath + ".tmp", storePath)
+
+
+
+
+
+if __name__ == '__main__':
+	rebuild(*[arg for arg in sys.argv[1:] if not arg.startswith("--")], **dict((arg[2:].split("=", 1) + [True])[:2] for arg in sys.argv[1:] if arg.startswith("--")))
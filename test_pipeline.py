@@ -0,0 +1,42 @@
+import threading, unittest
+
+from pipeline import Pipeline
+
+
+
+class ReserveTest(unittest.TestCase):
+	def test_reserveWhileCoresAreHeld(self):
+		# zoom of one save holds the whole budget while the next game reserves its cores and a task waits for the game without cores.
+		pipeline = Pipeline(8, 10**6)
+		zoomDone, gameDone = threading.Event(), threading.Event()
+		granted = {}
+
+		def task(name, event=None):
+			def run(cores):
+				granted[name] = cores
+				if event is not None:
+					event.wait(10)
+			return run
+
+		pipeline.add("zoom", task("zoom", zoomDone), cores=8)
+		pipeline.reserve(4)
+		pipeline.add("wait", task("wait", gameDone))
+		self.assertEqual(pipeline.freeCores, -4)
+
+		zoomDone.set()
+		pipeline.add("crop", task("crop"), after=["zoom"], cores=8)
+		with pipeline.condition:
+			while "crop" not in pipeline.done:
+				pipeline.condition.wait(10)
+		self.assertEqual(granted["crop"], 4)
+		self.assertEqual(granted["wait"], 0)
+
+		gameDone.set()
+		pipeline.release(4)
+		pipeline.join()
+		self.assertEqual(pipeline.freeCores, 8)
+
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,107 @@
+import os, struct, zlib
+import numpy
+from PIL import Image
+
+import workers
+
+
+
+PNGSIGNATURE = b"\x89PNG\r\n\x1a\n"
+FILTERROWS = 16
+
+# the thumbnail (Images/thumbnail.png, the preview image of the page) is the min zoom level of the last snapshot stitched together.
+# it is built one row of min zoom tiles at a time: the workers load, scale, paste and filter the tiles of a strip, the step only compresses the finished strips into the png.
+# so only the few strips that are in flight are ever in memory, however large the map. --thumbnailsize caps its longest side, the tiles are scaled down to fit.
+
+
+
+class PngWriter:
+	"""Writes an rgb png strip by strip, the strips come in already filtered (see filterRows) and are compressed as they arrive."""
+
+	def __init__(self, f, width, height):
+		self.f = f
+		self.compressor = zlib.compressobj()
+		f.write(PNGSIGNATURE)
+		self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+	def _chunk(self, tag, data):
+		self.f.write(struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data)))
+
+	def write(self, data):
+		data = self.compressor.compress(data)
+		if len(data) > 0:
+			self._chunk(b"IDAT", data)
+
+	def close(self):
+		self._chunk(b"IDAT", self.compressor.flush())
+		self._chunk(b"IEND", b"")
+
+
+def filterRows(rows):
+	"""returns the png scanlines of rows: the first row with the sub filter, so strips can be filtered apart from each other, the rest with paeth."""
+	rows = rows.reshape(len(rows), -1)
+	filtered = numpy.empty((len(rows), rows.shape[1] + 1), dtype=numpy.uint8)
+	filtered[:, 0] = 4
+	filtered[0, 0] = 1
+	filtered[0, 1:4] = rows[0, :3]
+	filtered[0, 4:] = rows[0, 3:] - rows[0, :-3]
+	# the predictor is taken from the unfiltered neighbours, so a block of rows is filtered at once. small blocks keep the int16 temporaries small.
+	for start in range(1, len(rows), FILTERROWS):
+		x = rows[start - 1:start + FILTERROWS].astype(numpy.int16)
+		above = x[:-1]
+		left = numpy.zeros_like(above)
+		left[:, 3:] = x[1:, :-3]
+		upperLeft = numpy.zeros_like(above)
+		upperLeft[:, 3:] = above[:, :-3]
+		p = left + above - upperLeft
+		pa, pb, pc = numpy.abs(p - left), numpy.abs(p - above), numpy.abs(p - upperLeft)
+		filtered[start:start + FILTERROWS, 1:] = x[1:] - numpy.where((pa <= pb) & (pa <= pc), left, numpy.where(pb <= pc, above, upperLeft))
+	return filtered.tobytes()
+
+
+
+def renderStrip(args):
+	"""pastes the tiles of one strip, each given as (path, left, top, right, bottom) in thumbnail pixels, on the background and returns its png scanlines.
+	tiles without a file are left background."""
+	tiles, width, top, bottom, background, remove = args
+	strip = numpy.empty((bottom - top, width, 3), dtype=numpy.uint8)
+	strip[:] = background
+	for path, left, tileTop, right, tileBottom in tiles:
+		if not os.path.isfile(path):
+			continue
+		img = Image.open(path, mode='r').convert("RGB")
+		if img.size != (right - left, tileBottom - tileTop):
+			img = img.resize((right - left, tileBottom - tileTop), Image.ANTIALIAS)
+		tile = numpy.asarray(img)
+		x0, x1, y0, y1 = max(left, 0), min(right, width), max(tileTop, top), min(tileBottom, bottom)
+		if x1 > x0 and y1 > y0:
+			strip[y0 - top:y1 - top, x0:x1] = tile[y0 - tileTop:y1 - tileTop, x0 - left:x1 - left]
+		if remove:
+			os.remove(path)
+	return filterRows(strip)
+
+
+def build(pool, workerCount, path, tiles, width, height, offset, tileSize, background, maxSize=None, remove=False):
+	"""tiles maps the (column, row) of every min zoom tile to its path, tile (0, 0) has its top left corner at offset in the width x height canvas.
+	remove deletes the tiles once they are pasted."""
+	scale = min(1, maxSize / max(width, height)) if maxSize else 1
+	edge = lambda v: int(round(v * scale))
+	outWidth, outHeight = max(1, edge(width)), max(1, edge(height))
+
+	rows = {}
+	for (column, row), tilePath in tiles.items():
+		rows.setdefault(row, []).append((tilePath, edge(offset[0] + column * tileSize), edge(offset[1] + row * tileSize), edge(offset[0] + (column + 1) * tileSize), edge(offset[1] + (row + 1) * tileSize)))
+	strips = []
+	row = -offset[1] // tileSize
+	while edge(offset[1] + row * tileSize) < outHeight:
+		top, bottom = max(edge(offset[1] + row * tileSize), 0), min(edge(offset[1] + (row + 1) * tileSize), outHeight)
+		if bottom > top:
+			strips.append((rows.get(row, []), outWidth, top, bottom, background, remove))
+		row += 1
+
+	with open(path + ".tmp", "wb") as f:
+		writer = PngWriter(f, outWidth, outHeight)
+		for strip in workers.iterBatches(pool, renderStrip, strips, workerCount):
+			writer.write(strip)
+		writer.close()
+	os.replace(path + ".tmp", path)
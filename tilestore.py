@@ -0,0 +1,53 @@
+import os
+import hashlib
+import threading
+
+
+
+STOREFOLDER = "store"
+
+# with --tilestore every encoded tile is kept once in <output>/store, named after the hash of its pixels.
+# the paths the viewer loads are hardlinks (default) or relative symlinks (--tilestore=symlink) to those blobs.
+# tiles with pixels that were already seen, like ocean or background tiles, are linked without being encoded again.
+
+_store = None
+
+
+
+def configure(folder, mode):
+	"""called in every process that saves tiles, mode is the value of --tilestore."""
+	global _store
+	_store = (folder, "symlink" if mode == "symlink" else "hardlink") if mode and mode != "false" else None
+
+
+def configured():
+	return _store is not None
+
+
+def save(arr, path, encode, encoding=None):
+	"""encoding names the encoder and its settings (see codec.tileFormat), the same pixels encoded differently are different blobs."""
+	folder, mode = _store
+	h = hashlib.blake2b(str((arr.shape, encoding)).encode(), digest_size=16)
+	h.update(arr.data)
+	digest = h.hexdigest()
+	blob = os.path.join(folder, digest[:2], digest + os.path.splitext(path)[1])
+
+	if not os.path.isfile(blob):
+		os.makedirs(os.path.dirname(blob), exist_ok=True)
+		tmp = "%s.%s.%s.tmp" % (blob, os.getpid(), threading.get_ident())
+		with open(tmp, "wb") as f:
+			f.write(encode(arr))
+		os.replace(tmp, blob)
+
+	# never write through an existing link, that would change every tile sharing the blob.
+	if os.path.lexists(path):
+		os.remove(path)
+	try:
+		if mode == "symlink":
+			os.symlink(os.path.relpath(blob, os.path.dirname(path)), path)
+		else:
+			os.link(blob, path)
+	except OSError:
+		# the blob ran out of hardlinks or the filesystem does not support links, store a plain copy.
+		with open(blob, "rb") as src, open(path, "wb") as dest:
+			dest.write(src.read())
@@ -0,0 +1,135 @@
+import os, sys, select, struct, time
+import ctypes, ctypes.util
+
+
+
+POLLINTERVAL = 0.4
+# with inotify the wait is woken by the kernel, the timeout is only a safety net for missed events (network drives, files written from a vm).
+WATCHINTERVAL = 5
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+EVENTSIZE = struct.calcsize("iIII")
+
+# waiting for the game: everything auto() and crop() wait for on disk goes through here.
+# on linux the waits sleep on inotify and wake as soon as the file shows up or changes,
+# everywhere else (and when inotify is unavailable or out of watches) they fall back to polling every POLLINTERVAL seconds.
+
+_libc = None
+
+
+
+def _inotify():
+	global _libc
+	if not sys.platform.startswith("linux"):
+		return None
+	if _libc is None:
+		try:
+			_libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+			_libc.inotify_init1.argtypes = (ctypes.c_int,)
+			_libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+		except (OSError, AttributeError):
+			_libc = False
+	return _libc or None
+
+
+
+class Watcher:
+	"""Waits for files to appear or change. Holds one inotify instance, close it (or use it as a context manager) when done."""
+
+	def __init__(self):
+		self.fd = None
+		self.watched = {}
+		libc = _inotify()
+		if libc is not None:
+			fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+			if fd >= 0:
+				self.fd = fd
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+	def _watch(self, path, mask):
+		"""returns the watch descriptor, or None when the caller has to poll."""
+		if self.fd is None:
+			return None
+		if (path, mask) not in self.watched:
+			wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+			if wd < 0:
+				# usually fs.inotify.max_user_watches, polling still works.
+				return None
+			self.watched[(path, mask)] = wd
+		return self.watched[(path, mask)]
+
+	def _read(self, timeout):
+		"""waits for events, returns them as (wd, mask, name) or an empty list on timeout."""
+		events = []
+		if len(select.select([self.fd], [], [], timeout)[0]) > 0:
+			try:
+				while True:
+					data = os.read(self.fd, 4096)
+					offset = 0
+					while offset < len(data):
+						wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+						events.append((wd, mask, os.fsdecode(data[offset + EVENTSIZE:offset + EVENTSIZE + length].rstrip(b"\0"))))
+						offset += EVENTSIZE + length
+			except BlockingIOError:
+				pass
+		return events
+
+	def waitFor(self, path, cancel=None, created=False):
+		"""blocks until path exists, returns False instead if cancel() became true first.
+		with inotify, a file that shows up while waiting only counts once it was closed after writing, so its content is complete.
+		created counts it as soon as it is created instead, for files the game keeps open like its log."""
+		path = os.path.abspath(path)
+		while not os.path.exists(path):
+			if cancel is not None and cancel():
+				return False
+			# the folders leading up to the file may not exist yet either, watch the deepest one that does and move down as they appear.
+			folder = os.path.dirname(path)
+			while not os.path.isdir(folder) and os.path.dirname(folder) != folder:
+				folder = os.path.dirname(folder)
+			wd = self._watch(folder, IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE)
+			if wd is None:
+				time.sleep(POLLINTERVAL)
+				continue
+			if folder != os.path.dirname(path) and os.path.isdir(os.path.dirname(path)):
+				continue
+
+			name = os.path.basename(path)
+			done = IN_CLOSE_WRITE | IN_MOVED_TO | IN_ISDIR | (IN_CREATE if created else 0)
+			while True:
+				events = self._read(WATCHINTERVAL)
+				if any(event[0] == wd and event[2] == name and event[1] & done for event in events):
+					return True
+				# on a timeout the file is checked again, in case the close was missed.
+				if len(events) == 0 or folder != os.path.dirname(path) or (cancel is not None and cancel()):
+					break
+		return True
+
+	def waitChange(self, path, timeout=POLLINTERVAL):
+		"""blocks until path was written to, or at most timeout seconds."""
+		wd = self._watch(os.path.abspath(path), IN_MODIFY | IN_CLOSE_WRITE)
+		if wd is None:
+			time.sleep(timeout)
+		else:
+			self._read(timeout)
+
+
+
+def waitFor(path, cancel=None, created=False):
+	with Watcher() as watcher:
+		return watcher.waitFor(path, cancel, created)
@@ -1,6 +1,6 @@
 "use strict";
 let DEBUG = false;
-const EXT = ".jpg";
+const EXT = ".jpg";	// tile extension of zoom levels and snapshots that do not list their own in mapInfo
 
 
 
@@ -13,31 +13,156 @@ let COORDSCALE = 2**19 / 16 * window.devicePixelRatio;
 
 
 L.TileLayer.prototype.getTileUrl = function(c) {
-	let mapIndex = this.tileIndex[c.z] && this.tileIndex[c.z][c.y] && this.tileIndex[c.z][c.y][c.x];
+	let mapIndex = this.tileIndex.lookup(c.z, c.x, c.y);
 	if (isNaN(mapIndex))
 		mapIndex = this.tileIndex.fallback;
 	if (isNaN(mapIndex))
 		return "";
-	return "Images/" + mapInfo.maps[mapIndex].path + "/" + this.surface + "/" + this.daytime + "/" + c.z + "/" + c.x + "/" + c.y + EXT;
+	if (isSolid(mapInfo.maps[mapIndex], this.surface, this.daytime, c.z, c.x, c.y))
+		return SOLIDTILE;
+	return "Images/" + mapInfo.maps[mapIndex].path + "/" + this.surface + "/" + this.daytime + "/" + c.z + "/" + c.x + "/" + c.y + tileExtension(mapInfo.maps[mapIndex], c.z);
+}
+
+function tileExtension(map, z) {
+	return (map && map.extensions || {})[z] || EXT;
+}
+
+// Tiles that are nothing but background are not saved, window.solidIndexes holds the solid.bin of each snapshot, surface and daytime that has any (see chunks.py).
+const SOLIDTILE = (function() {
+	const canvas = document.createElement("canvas");
+	canvas.width = canvas.height = 1;
+	const context = canvas.getContext("2d");
+	context.fillStyle = "rgb(27, 45, 51)";
+	context.fillRect(0, 0, 1, 1);
+	return canvas.toDataURL();
+})();
+let solidTiles = {};
+function isSolid(map, surface, daytime, z, x, y) {
+	const name = "Images/" + map.path + "/" + surface + "/" + daytime + "/solid.bin";
+	if (!(name in solidTiles)) {
+		solidTiles[name] = new Set();
+		const bytes = Uint8Array.from(atob((window.solidIndexes || {})[name] || ""), c => c.charCodeAt(0));
+		const view = new DataView(bytes.buffer);
+		console.assert(bytes.length == 0 || String.fromCharCode(...bytes.slice(0, 4)) == "FMSO" && view.getUint16(4, true) == 1); //unknown solid index
+		for (let offset = 12; offset + 12 <= bytes.length; offset += 12)
+			solidTiles[name].add(view.getInt32(offset, true) + "/" + view.getInt32(offset + 4, true) + "/" + view.getInt32(offset + 8, true));
+	}
+	return solidTiles[name].has(z + "/" + x + "/" + y);
 }
 
 //TODO: iterate over surfaces
 //let surface = Object.keys(mapInfo.maps[0].surfaces)[0];
 
+// One snapshot's index of changed max zoom images of a surface. Rows are only decoded when a tile lookup needs them.
+// Binary indexes (see chunks.py) come from window.chunkIndexes, older mapInfo.json files still contain the '='-joined base64 string.
+function ChunkIndex(mapIndex, layer) {
+	this.mapIndex = mapIndex;
+	this.rowCache = {};
+	if (layer.chunkIndex) {
+		const bytes = Uint8Array.from(atob(window.chunkIndexes[layer.chunkIndex] || ""), c => c.charCodeAt(0));
+		this.view = new DataView(bytes.buffer);
+		console.assert(bytes.length >= 12 && String.fromCharCode(...bytes.slice(0, 4)) == "FMCI" && this.view.getUint16(4, true) == 1); //unknown or missing index
+		this.rowCount = bytes.length >= 12 ? this.view.getUint32(8, true) : 0;
+		this.runOffset = 12 + 12 * this.rowCount;
+		this.rowY = i => this.view.getInt32(12 + 12 * i, true);
+		this.decodeRow = this.decodeBinaryRow;
+	} else {
+		this.rows = (layer.chunks || "").split('=').filter(row => row.length > 0);
+		this.ys = this.rows.map(row => this.B64Parse(row, 0) - 2**17);
+		const order = this.ys.map((_, i) => i).sort((a, b) => this.ys[a] - this.ys[b]);
+		this.rows = order.map(i => this.rows[i]);
+		this.ys = order.map(i => this.ys[i]);
+		this.rowCount = this.rows.length;
+		this.rowY = i => this.ys[i];
+		this.decodeRow = this.decodeStringRow;
+	}
+}
+ChunkIndex.prototype.B64Parse = function(row, offset) {
+	return "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/".indexOf(row[offset])
+	+ 64 * "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/".indexOf(row[offset+1])
+	+64*64*"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/".indexOf(row[offset+2])
+	- 2**16;
+}
+// both decoders return a row as a list of [start, stop, isDay] runs.
+ChunkIndex.prototype.decodeBinaryRow = function(i) {
+	let runs = [];
+	const first = this.view.getUint32(16 + 12 * i, true), count = this.view.getUint32(20 + 12 * i, true);
+	for (let j = first; j < first + count; j++) {
+		const start = this.view.getInt32(this.runOffset + 8 * j, true), value = this.view.getUint32(this.runOffset + 8 * j + 4, true);
+		runs.push([start, start + (value >>> 1), (value & 1) == 1]);
+	}
+	return runs;
+}
+ChunkIndex.prototype.decodeStringRow = function(i) {
+	let runs = [], row = this.rows[i];
+	console.assert(row.length % 3 == 0); //corrupted data, prevent infinite loop
+	let j = 3;
+	while (j < row.length) {
+		let stop = this.B64Parse(row, j + 3);
+		let start = this.B64Parse(row, j);
+		let mode = start > 2**16;
+		runs.push([start - mode*2**17, stop - (stop>2**16)*2**17, mode]);
+		j += mode == stop > 2**16 ? 6 : 3;
+	}
+	return runs;
+}
+// does this snapshot have any image within the max zoom rectangle [x0, x1) x [y0, y1)?
+ChunkIndex.prototype.contains = function(x0, x1, y0, y1, dayOnly) {
+	let low = 0, high = this.rowCount;
+	while (low < high) {
+		const mid = (low + high) >> 1;
+		if (this.rowY(mid) < y0)
+			low = mid + 1;
+		else
+			high = mid;
+	}
+	for (let i = low; i < this.rowCount && this.rowY(i) < y1; i++) {
+		if (!(i in this.rowCache))
+			this.rowCache[i] = this.decodeRow(i);
+		for (const [start, stop, isDay] of this.rowCache[i])
+			if (start < x1 && stop > x0 && (isDay || !dayOnly))
+				return true;
+	}
+	return false;
+}
+
+// Resolves which snapshot last rendered a tile, looking at the chunk indexes of the layer's own snapshot and the ones before it.
+function TileIndex(chunkIndexes, fallback, maxZoom, dayOnly) {
+	this.chunkIndexes = chunkIndexes;
+	this.fallback = fallback;
+	this.maxZoom = maxZoom;
+	this.dayOnly = dayOnly;
+	this.cache = {};
+}
+TileIndex.prototype.lookup = function(z, x, y) {
+	const key = z + "/" + x + "/" + y;
+	if (!(key in this.cache)) {
+		const shift = Math.max(this.maxZoom - z, 0);
+		this.cache[key] = NaN;
+		for (let j = this.chunkIndexes.length - 1; j >= 0; j--)
+			if (this.chunkIndexes[j].contains(x * 2**shift, (x + 1) * 2**shift, y * 2**shift, (y + 1) * 2**shift, this.dayOnly)) {
+				this.cache[key] = this.chunkIndexes[j].mapIndex;
+				break;
+			}
+	}
+	return this.cache[key];
+}
+
+
 // Reorder maps by their time
 mapInfo['maps'].sort((a,b) => parseInt(a.path) > parseInt(b.path) ? 1 : -1);
 
 
 let layers = [], saves = [], countAvailableSaves = 0, layersByTimestamp = [], labels = [];
-let globalTileIndex = {};
-let globalTileNightIndex = {};
+let globalChunkIndexes = {};
+let globalTileFallback = {};
 const maxZoomExtra = 2 + Math.round(Math.log2(window.devicePixelRatio));
 let globalMaxZoom = NaN;
 
 for (let i = 0; i < mapInfo.maps.length; i++) {
 	if (DEBUG) {
-		globalTileIndex = {};
-		globalTileNightIndex = {};
+		globalChunkIndexes = {};
+		globalTileFallback = {};
 	}
 
 	let map = mapInfo.maps[i];
@@ -56,76 +181,13 @@ for (let i = 0; i < mapInfo.maps.length; i++) {
 
 		TILESPERIMAGE = layer.zoom.max == 20 ? 16 : 8;
 
-		if (!globalTileNightIndex[surface]) {
-			globalTileNightIndex[surface] = layer.chunks ? {} : {fallback: i};
-			globalTileIndex[surface] = layer.chunks ? {} : {fallback: i};
-		}
-		for (let z = layer.zoom.min; z <= layer.zoom.max; z++)
-			if (!globalTileNightIndex[surface][z]) {
-				globalTileNightIndex[surface][z] = {};
-				globalTileIndex[surface][z] = {};
-			}
-		(layer.chunks || "").split('=').forEach(function(row) {
-			function B64Parse(offset) {
-				return "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/".indexOf(row[offset])
-				+ 64 * "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/".indexOf(row[offset+1])
-				+64*64*"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/".indexOf(row[offset+2])
-				- 2**16;
-			}
-
-			console.assert(row.length % 3 == 0); //corrupted data, prevent infinite loop
-			let j = 3, y = B64Parse(0) - 2**17;
-			
-			if (!globalTileNightIndex[surface][layer.zoom.max][y]){
-				globalTileNightIndex[surface][layer.zoom.max][y] = {};
-				globalTileIndex[surface][layer.zoom.max][y] = {};
-			}
-			while (j < row.length) {
-				let stop = B64Parse(j + 3)
-				let start = B64Parse(j);
-				let mode = start > 2**16;
-				for (let x = start - mode*2**17; x < (stop - (stop>2**16)*2**17); x++) {
-					globalTileNightIndex[surface][layer.zoom.max][y][x] = i;
-					if (mode)
-						globalTileIndex[surface][layer.zoom.max][y][x] = i;
-					for (let z = 1; z <= layer.zoom.max - layer.zoom.min; z++)  {
-						if (!globalTileNightIndex[surface][layer.zoom.max-z][y >> z]) {
-							globalTileNightIndex[surface][layer.zoom.max-z][y >> z] = {};
-							globalTileIndex[surface][layer.zoom.max-z][y >> z] = {};
-						}
-						if ((mode ? globalTileIndex : globalTileNightIndex)[surface][layer.zoom.max-z][y >> z][x >> z] == i)
-							break;
-						globalTileNightIndex[surface][layer.zoom.max-z][y >> z][x >> z] = i;
-						if (mode)
-							globalTileIndex[surface][layer.zoom.max-z][y >> z][x >> z] = i;
-					}
-				}
-				j += mode == stop > 2**16 ? 6 : 3;
-			}
-		});
-
-		let tileIndex = { fallback: globalTileIndex[surface].fallback };
-		for (const z in globalTileIndex[surface]) {
-			if (z == "fallback")
-				continue;
-			tileIndex[z] = {};
-			for (const y in globalTileIndex[surface][z]) {
-				tileIndex[z][y] = {};
-				for (const x in globalTileIndex[surface][z][y])
-					tileIndex[z][y][x] = globalTileIndex[surface][z][y][x];
-			}
-		}
-		let tileNightIndex = { fallback: globalTileNightIndex[surface].fallback };
-		for (const z in globalTileNightIndex[surface]) {
-			if (z == "fallback")
-				continue;
-			tileNightIndex[z] = {};
-			for (const y in globalTileNightIndex[surface][z]) {
-				tileNightIndex[z][y] = {};
-				for (const x in globalTileNightIndex[surface][z][y])
-					tileNightIndex[z][y][x] = globalTileNightIndex[surface][z][y][x];
-			}
+		if (!globalChunkIndexes[surface]) {
+			globalChunkIndexes[surface] = [];
+			globalTileFallback[surface] = layer.chunks || layer.chunkIndex ? undefined : i;
 		}
+		if (layer.chunks || layer.chunkIndex)
+			globalChunkIndexes[surface].push(new ChunkIndex(i, layer));
+		const chunkIndexes = globalChunkIndexes[surface].slice();
 
 
 		layersByTimestamp[i][surface] = {};
@@ -235,7 +297,7 @@ for (let i = 0; i < mapInfo.maps.length; i++) {
 				LLayer.surface = surface;
 				LLayer.daytime = daytime;
 				LLayer.path = map.path;
-				LLayer.tileIndex = daytime == "day" ? tileIndex : tileNightIndex;
+				LLayer.tileIndex = new TileIndex(chunkIndexes, globalTileFallback[surface], layer.zoom.max, daytime == "day");
 
 
 				map.surfaces[surface].layers[daytime] = layersByTimestamp[i][surface][daytime] = layers[surface][i][daytime] = LLayer;
@@ -343,7 +405,7 @@ function updateRenderboxUrls() {
 				const z = Math.min(marker.link.zoom.max, Math.max(marker.link.zoom.min, map.getZoom() - marker.zOffset));
 				if (marker._lastZ != z) {
 					marker._lastZ = z;
-					marker.setUrl("Images/" + marker.link.path + "/" + marker.link.toSurface + "/" + (marker.link.daynight ? label.daytime : "day") + "/renderboxes/" + z + "/" + marker.link.filename + ".jpg");
+					marker.setUrl("Images/" + marker.link.path + "/" + marker.link.toSurface + "/" + (marker.link.daynight ? label.daytime : "day") + "/renderboxes/" + z + "/" + marker.link.filename + tileExtension(mapInfo.maps.find(m => m.path == marker.link.path), z));
 				}
 			}
 }
@@ -0,0 +1,104 @@
+import os, queue
+import psutil
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+import codec
+import pack
+import tilestore
+import writebehind
+
+
+
+# auto() starts one pool of worker processes for the whole run, crop, ref and zoom of every surface and save send their work to it.
+# the workers are set up once: the codecs are loaded, the output modes configured and the signature and owner index caches stay warm between steps.
+# steps that are run on their own start a pool of their own like they always did.
+# with --workers=threads the pools are thread pools instead: nothing is pickled and the signature and owner index caches exist once,
+# at the cost of the work that holds the gil (numpy reductions, python loops) not running in parallel. decoding, resizing and encoding release it.
+
+_shared = None
+
+
+
+def initWorker(toppath, options):
+	# the output modes are module state, every process that saves tiles sets them up from the command line options.
+	psutil.Process(os.getpid()).nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == 'nt' else 10)
+	configure(toppath, options)
+
+
+def configure(toppath, options):
+	tilestore.configure(os.path.join(toppath, tilestore.STOREFOLDER), options.get("tilestore"))
+	pack.configure(options.get("pack"))
+	codec.configure(options.get("tileformat"))
+	writebehind.configure(options.get("writebehind"))
+
+
+def threaded(options):
+	return options is not None and options.get("workers") == "threads"
+
+
+def newPool(processes, toppath=None, options=None):
+	if threaded(options):
+		# threads share the module state of the process that runs the step, which already lowered its own priority.
+		if toppath is None:
+			return ThreadPool(processes=processes)
+		return ThreadPool(processes=processes, initializer=configure, initargs=(toppath, options))
+	if toppath is None:
+		return mp.Pool(processes=processes)
+	return mp.Pool(processes=processes, initializer=initWorker, initargs=(toppath, options))
+
+
+def start(processes, toppath, options):
+	global _shared
+	_shared = (os.path.abspath(toppath), newPool(processes, toppath, options))
+
+
+def stop():
+	global _shared
+	if _shared is not None:
+		_shared[1].close()
+		_shared[1].join()
+		_shared = None
+
+
+def acquire(processes, toppath=None, options=None):
+	"""returns the shared pool if auto() started one (for the same output folder, when the step saves tiles), otherwise a new pool of processes workers."""
+	if _shared is not None and (toppath is None or _shared[0] == os.path.abspath(toppath)):
+		return _shared[1]
+	return newPool(processes, toppath, options)
+
+
+def release(pool):
+	if _shared is None or pool is not _shared[1]:
+		pool.close()
+		pool.join()
+
+
+def runBatches(pool, func, batches, workers, progress=None):
+	"""runs func on every batch, with only a few batches per worker queued at a time so steps sharing the pool stay close to the cores they were given.
+	progress is called with every result as it arrives, the results are returned in order."""
+	results = [None] * len(batches)
+	done = queue.Queue()
+	submitted = 0
+	for finished in range(len(batches)):
+		while submitted < len(batches) and submitted - finished < 2 * workers:
+			pool.apply_async(func, (batches[submitted],), callback=lambda result, i=submitted: done.put((i, result, None)), error_callback=lambda e, i=submitted: done.put((i, None, e)))
+			submitted += 1
+		i, result, error = done.get()
+		if error is not None:
+			raise error
+		results[i] = result
+		if progress is not None:
+			progress(result)
+	return results
+
+
+def iterBatches(pool, func, batches, workers):
+	"""like runBatches, but yields the results in order as they come in, so a step can stream them out without holding every result at once."""
+	pending = {}
+	submitted = 0
+	for i in range(len(batches)):
+		while submitted < len(batches) and submitted - i < 2 * workers:
+			pending[submitted] = pool.apply_async(func, (batches[submitted],))
+			submitted += 1
+		yield pending.pop(i).get()
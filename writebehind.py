@@ -0,0 +1,155 @@
+import os, queue, threading, time
+
+
+
+WRITEBEHINDDEPTH = 64
+
+# with --writebehind the workers hand their encoded tiles (and the screenshots to delete) to a background thread and go on encoding,
+# instead of waiting on open/write/remove themselves. --writebehind=N bounds the queue to N items, a worker that gets that far ahead of the disk waits.
+# folders are created once per process, deletions of a whole list take one queue item. without --writebehind everything happens inline, as before.
+# files are only on disk after flush(): every task flushes before it returns, as other tasks and steps read what it wrote.
+# flush() returns the io done since the last flush, so the steps can report it apart from the time spent encoding.
+# every worker has a queue and writer thread of its own, also with --workers=threads, so a flush only ever waits for and reports the caller's own files.
+# flush() also stops the writer thread, the next write starts a new one. so the short lived threads of the pipeline do not leave writers behind.
+
+_depth = 0
+_folders = set()
+_local = threading.local()
+
+
+
+class _Writer:
+	def __init__(self, depth):
+		self.depth = depth
+		self.queue = queue.Queue(depth) if depth > 0 else None
+		self.error = None
+		self.lock = threading.Lock()
+		self.stats = newStats()
+		if self.queue is not None:
+			threading.Thread(target=self._run, daemon=True).start()
+
+	def count(self, key, value):
+		with self.lock:
+			self.stats[key] = max(self.stats[key], value) if key == "depth" else self.stats[key] + value
+
+	def _run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				return
+			try:
+				if self.error is None:
+					_do(item, self)
+			except Exception as e:
+				self.error = e
+			self.queue.task_done()
+
+	def submit(self, item):
+		start = time.perf_counter()
+		if self.queue is None:
+			_do(item, self)
+		else:
+			if self.error is not None:
+				raise self.error
+			self.queue.put(item)
+			self.count("depth", self.queue.qsize())
+		self.count("waited", time.perf_counter() - start)
+
+	def flush(self):
+		if self.queue is not None:
+			start = time.perf_counter()
+			self.queue.join()
+			self.queue.put(None)
+			self.count("waited", time.perf_counter() - start)
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error
+		with self.lock:
+			stats, self.stats = self.stats, newStats()
+		return stats
+
+
+
+def newStats():
+	return {"files": 0, "bytes": 0, "removed": 0, "io": 0.0, "waited": 0.0, "depth": 0}
+
+
+def addStats(total, stats):
+	for key, value in stats.items():
+		total[key] = max(total[key], value) if key == "depth" else total[key] + value
+	return total
+
+
+def describe(stats):
+	return "io: wrote %s files (%.1f MiB) and removed %s in %.1fs (%.1f MiB/s), queue depth up to %s, workers waited %.1fs on io" % (
+		stats["files"], stats["bytes"] / 2**20, stats["removed"], stats["io"], stats["bytes"] / 2**20 / max(stats["io"], 1e-6), stats["depth"], stats["waited"])
+
+
+def configure(mode):
+	"""called in every process that saves tiles, mode is the value of --writebehind. a worker that has files queued switches over after its next flush."""
+	global _depth
+	_depth = 0 if not mode or mode == "false" else WRITEBEHINDDEPTH if mode is True or mode == "true" else int(mode)
+
+
+def _writer():
+	# a forked worker inherits the writer of the thread that forked it, but not its thread.
+	writer = getattr(_local, "writer", None)
+	if writer is None or _local.pid != os.getpid():
+		writer = _local.writer = _Writer(_depth)
+		_local.pid = os.getpid()
+	return writer
+
+
+def makedirs(folder):
+	if folder not in _folders:
+		os.makedirs(folder, exist_ok=True)
+		_folders.add(folder)
+
+
+def _write(path, data):
+	try:
+		f = open(path, "wb")
+	except FileNotFoundError:
+		# the folder is new, or was removed since it was created (empty folders are cleaned up after ref).
+		_folders.discard(os.path.dirname(path))
+		makedirs(os.path.dirname(path))
+		f = open(path, "wb")
+	with f:
+		f.write(data)
+
+
+def _do(item, writer):
+	start = time.perf_counter()
+	if item[0] == "write":
+		_write(item[1], item[2])
+		writer.count("files", 1)
+		writer.count("bytes", len(item[2]))
+	else:
+		for path in item[1]:
+			os.remove(path)
+		writer.count("removed", len(item[1]))
+	writer.count("io", time.perf_counter() - start)
+
+
+def write(path, data):
+	"""writes data (bytes or a memoryview, which is copied when queued) to path, creating its folder if needed."""
+	writer = _writer()
+	writer.submit(("write", path, data if writer.queue is None else bytes(data)))
+
+
+def remove(path):
+	_writer().submit(("remove", [path]))
+
+
+def removeAll(paths):
+	if len(paths) > 0:
+		_writer().submit(("remove", list(paths)))
+
+
+def flush():
+	"""waits until everything this thread queued is on disk, raises the first error its writer ran into. returns the stats since the last flush."""
+	writer = getattr(_local, "writer", None)
+	if writer is None or _local.pid != os.getpid():
+		return newStats()
+	_local.writer = None
+	return writer.flush()
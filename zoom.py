@@ -1,31 +1,42 @@
+import functools
 import json
 import math
-import multiprocessing as mp
 import os
 import subprocess
 import sys
 import time
 import numpy
-from turbojpeg import TurboJPEG
 from shutil import get_terminal_size as tsize
 from sys import platform as _platform
 
 import psutil
 from PIL import Image, ImageChops
 
-maxQuality = False  		# Set this to true if you want to compress/postprocess the images yourself later
-useBetterEncoder = True 	# Slower encoder that generates smaller images.
+import chunks
+import codec
+import owners
+import pack
+import thumbnail
+import tilestore
+import workers
+import writebehind
+from scheduler import Scheduler
+from codec import loadTile, downsample, combine, QUADRANTS
 
-quality = 80
+maxQuality = False  		# Set this to true if you want to compress/postprocess the images yourself later
 	
 EXT = ".png"
-OUTEXT = ".jpg"     		# format='JPEG' is hardcoded in places, meed to modify those, too. Most parameters are not supported outside jpeg.
-THUMBNAILEXT = ".png"
+# the tile formats and qualities are picked per zoom level with --tileformat, see codec.py.
 
 BACKGROUNDCOLOR = (27, 45, 51)
 THUMBNAILSCALE = 2
 
 MINRENDERBOXSIZE = 8
+RENDERBOXLEVELCOST = 256*256	# the cost of writing one level of a renderbox, counted in pixels
+
+ZOOMMEMORY = 512			# MiB of tiles a zoom worker may hold in memory, see --zoommemory
+ZOOMTILESPERLEVEL = 4		# full size tiles a worker holds per level of its subtree: the four children, the parent and the decode and encode buffers
+TASKSPERTHREAD = 8
 
 
 
@@ -38,42 +49,74 @@ def printErase(arg):
 		pass
 
 
-# note that these are all 64 bit libraries since factorio doesnt support 32 bit.
-if os.name == "nt":
-	jpeg = TurboJPEG("mozjpeg/turbojpeg.dll")
-# elif _platform == "darwin":						# I'm not actually sure if mac can run linux libraries or not.
-# 	jpeg = TurboJPEG("mozjpeg/libturbojpeg.dylib")	# If anyone on mac has problems with the line below please make an issue :)
-else:
-	jpeg = TurboJPEG("mozjpeg/libturbojpeg.so")
-
-
-def saveCompress(img, path, inpath=None):
+def saveCompress(img, path, z):
+	"""encodes img as a tile of zoom level z, path is without extension. returns the file it was written to, None if it went into a pack."""
+	# img is an RGB array or a PIL image, which costs one copy to turn into an array.
+	arr = numpy.ascontiguousarray(img)
+	path += codec.extension(z)
 	if maxQuality:  # do not waste any time compressing the image
-		return img.save(path, subsampling=0, quality=100)
-
-	
-	out_file = open(path, 'wb')
-	out_file.write(jpeg.encode(numpy.array(img)[:, :, ::-1].copy() ))
-	out_file.close()
-
-def simpleZoom(workQueue):
-	for (folder, start, stop, filename) in workQueue:
+		Image.fromarray(arr).save(path, subsampling=0, quality=100)
+		return path
+
+	if pack.enabled() and pack.locate(path) is not None:
+		pack.put(path, bytes(codec.encodeTile(arr, z)))
+		return None
+	if tilestore.configured():
+		tilestore.save(arr, path, lambda arr: codec.encodeTile(arr, z), codec.tileFormat(z))
+		return path
+
+	writebehind.write(path, codec.encodeTile(arr, z))
+	return path
+
+def saveScreenshot(img, path, z):
+	"""encodes the screenshot path + EXT as the tile of level z, and removes the screenshot unless the tile took its place."""
+	if saveCompress(img, path, z) != path + EXT:
+		writebehind.remove(path + EXT)
+
+def simpleZoom(batch):
+	"""zooms out a batch of renderboxes, each given as (folder, start, stop, filename), with the downsample and encoder the tile pyramid uses. returns the io stats."""
+	for (folder, start, stop, filename) in batch:
 		path = os.path.join(folder, str(start), filename)
-		img = Image.open(path + EXT, mode='r').convert("RGB")
-		if OUTEXT != EXT:
-			saveCompress(img, path + OUTEXT, path + EXT)
-			os.remove(path + EXT)
+		img = numpy.asarray(Image.open(path + EXT, mode='r').convert("RGB"))
+		saveScreenshot(img, path, start)
 
 		for z in range(start - 1, stop - 1, -1):
-			if img.size[0] >= MINRENDERBOXSIZE*2 and img.size[1] >= MINRENDERBOXSIZE*2:
-				img = img.resize((img.size[0]//2, img.size[1]//2), Image.ANTIALIAS)
-			zFolder = os.path.join(folder, str(z))
-			if not os.path.exists(zFolder):
-				os.mkdir(zFolder)
-			saveCompress(img, os.path.join(zFolder, filename + OUTEXT))
+			if img.shape[1] >= MINRENDERBOXSIZE*2 and img.shape[0] >= MINRENDERBOXSIZE*2:
+				img = downsample(img)
+			saveCompress(img, os.path.join(folder, str(z), filename), z)
+	return writebehind.flush()
+
+
+def renderboxCost(job):
+	"""estimates the work of zooming a renderbox from its size (only the header is read) and level count, in pixels."""
+	folder, start, stop, filename = job
+	width, height = Image.open(os.path.join(folder, str(start), filename + EXT), mode='r').size
+	cost = 0
+	for z in range(start, stop - 1, -1):
+		cost += width * height + RENDERBOXLEVELCOST
+		if width >= MINRENDERBOXSIZE*2 and height >= MINRENDERBOXSIZE*2:
+			width, height = width // 2, height // 2
+	return cost
+
+
+def renderboxBatches(zoomWork, workerCount):
+	"""splits the renderboxes into batches of about equal cost, largest first. a renderbox bigger than a batch is a batch of its own.
+	the pool hands out the next batch to whichever worker is free, so the big ones start early and the small ones fill in the gaps at the end."""
+	jobs = sorted(((renderboxCost(job), job) for job in zoomWork), key=lambda item: item[0], reverse=True)
+	target = sum(cost for cost, _ in jobs) / (TASKSPERTHREAD * workerCount) if len(jobs) > 0 else 0
+	batches = []
+	batchCost = 0
+	for cost, job in jobs:
+		if len(batches) == 0 or batchCost + cost > target:
+			batches.append([])
+			batchCost = 0
+		batches[-1].append(job)
+		batchCost += cost
+	return batches
 
 
 def zoomRenderboxes(daytimeSurfaces, workfolder, timestamp, subpath, **kwargs):
+	workers.configure(workfolder, kwargs)
 	with open(os.path.join(workfolder, "mapInfo.json"), 'r+') as mapInfoFile:
 		mapInfo = json.load(mapInfoFile)
 
@@ -126,6 +169,7 @@ def zoomRenderboxes(daytimeSurfaces, workfolder, timestamp, subpath, **kwargs):
 							# an assumption is made that the total zoom levels required doesnt change between snapshots.
 							if (link if "path" in link else outInfo["maps"][mapIndex]["surfaces"][surfaceName]["links"][linkIndex])["path"] == timestamp:
 								zoomWork.add((os.path.abspath(os.path.join(subpath, mapLayer["path"], link["toSurface"], daytime if link["daynight"] else "day", "renderboxes")), link["zoom"]["max"], link["zoom"]["min"], link["filename"]))
+								outInfo["maps"][mapIndex].setdefault("extensions", {}).update((str(z), codec.extension(z)) for z in range(link["zoom"]["min"], link["zoom"]["max"] + 1))
 
 		
 		mapInfoOutFile.seek(0)
@@ -135,14 +179,11 @@ def zoomRenderboxes(daytimeSurfaces, workfolder, timestamp, subpath, **kwargs):
 
 						
 	maxthreads = int(kwargs["zoomthreads" if kwargs["zoomthreads"] else "maxthreads"])
-	processes = []
-	zoomWork = list(zoomWork)
-	for i in range(0, min(maxthreads, len(zoomWork))):
-		p = mp.Process(target=simpleZoom, args=(zoomWork[i::maxthreads],))
-		p.start()
-		processes.append(p)
-	for p in processes:
-		p.join()
+	pool = workers.acquire(maxthreads, workfolder, kwargs)
+	stats = workers.runBatches(pool, simpleZoom, renderboxBatches(zoomWork, maxthreads), maxthreads)
+	if kwargs.get("verbose"):
+		print("renderbox " + writebehind.describe(functools.reduce(writebehind.addStats, stats, writebehind.newStats())))
+	workers.release(pool)
 					
 
 
@@ -150,89 +191,88 @@ def zoomRenderboxes(daytimeSurfaces, workfolder, timestamp, subpath, **kwargs):
 
 
 
-def work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast=False):
-	chunksize = 2**(start-stop)
+def findTile(basepath, pathList, surfaceName, daytime, z, x, y):
+	ownerIndex = owners.cachedIndex(os.path.join(basepath, pathList[0], surfaceName, daytime, owners.OWNERFILE))
+	if ownerIndex is not None:
+		owner = ownerIndex.lookup(z, x, y)
+		if owner is None:
+			return None
+		return codec.tileFile(os.path.join(basepath, pathList[len(pathList) - 1 - owner], surfaceName, daytime, str(z), str(x), str(y)), z)
+
+	# timelines without owner index
+	for n in range(0, len(pathList)):
+		path = codec.tileFile(os.path.join(basepath, pathList[n], surfaceName, daytime, str(z), str(x), str(y)), z)
+		if path is not None:
+			return path
+	return None
+
+
+def reduceTile(basepath, pathList, surfaceName, daytime, size, start, stop, last, k, x, y, keepLast=False, dirty=None, solid=None):
+	# depth first: each tile is compressed as soon as its four children are done, so a worker only holds the half size children along one branch.
+	# returns the tile at half size for its parent, or None if this snapshot has nothing there.
+	# dirty holds the tiles per level that have a changed tile below them, the rest of the subtree is not even looked at.
+	# tiles that are nothing but background are not saved when solid is given, their (z, x, y) are added to it instead.
+	path = os.path.join(basepath, pathList[0], surfaceName, daytime, str(k), str(x), str(y))
+	if k == start:
+		if os.path.isfile(path + EXT):
+			img = numpy.asarray(Image.open(path + EXT, mode='r').convert("RGB"))
+			saveScreenshot(img, path, k)
+			return downsample(img)
+		tilePath = codec.tileFile(path, k)
+		if tilePath is not None:
+			return loadTile(tilePath, 2)
+		if solid is not None and (x, y) in dirty[k]:
+			# the task below rendered this tile and found it to be solid background.
+			return codec.solidTile(size // 2, BACKGROUNDCOLOR)
+		return None
+
+	children = [None if dirty is not None and (2*x+coord[0], 2*y+coord[1]) not in dirty[k+1] else
+				reduceTile(basepath, pathList, surfaceName, daytime, size, start, stop, last, k+1, 2*x+coord[0], 2*y+coord[1], keepLast, dirty, solid) for coord in QUADRANTS]
+	if all(child is None for child in children):
+		return None
+
+	for m, coord in enumerate(QUADRANTS):
+		if children[m] is None:
+			oldPath = findTile(basepath, pathList, surfaceName, daytime, k+1, 2*x+coord[0], 2*y+coord[1])
+			# solid tiles of older snapshots have no file either, they are background like missing ones.
+			if oldPath is not None and pack.exists(oldPath):
+				# tiles taken from older snapshots are only needed at half size, let the jpeg decoder do the scaling.
+				children[m] = loadTile(oldPath, 2)
+	result = combine(children, size, BACKGROUNDCOLOR)
+
+	if not pack.enabled() or keepLast and k == last:
+		writebehind.makedirs(os.path.dirname(path))
+	if solid is not None and codec.isSolid(result, BACKGROUNDCOLOR):
+		# the thumbnail leaves tiles without a file background, so these need no copy for it either.
+		solid.append((k, x, y))
+	# the thumbnail is made from full color copies of the last level.
+	elif saveCompress(result, path, k) != path + EXT and k == last and keepLast:
+		Image.fromarray(result).save(path + EXT)
+
+	if k > stop:
+		return downsample(result)
+
+
+def work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast=False, tiles=None):
+	"""renders one subtree, returns the (z, x, y) of the tiles that were solid background and not saved, and the io stats."""
+	solid = []
 	if start > stop:
-		for k in range(start, stop, -1):
-			x = chunksize*chunk[0]
-			y = chunksize*chunk[1]
-			for j in range(y, y + chunksize, 2):					
-				for i in range(x, x + chunksize, 2):
-
-					coords = [(0,0), (1,0), (0,1), (1,1)]
-					paths = [os.path.join(basepath, pathList[0], surfaceName, daytime, str(k), str(i+coord[0]), str(j+coord[1]) + EXT) for coord in coords]
-
-					if any(os.path.isfile(path) for path in paths):
-
-						if not os.path.exists(os.path.join(basepath, pathList[0], surfaceName, daytime, str(k-1), str(i//2))):
-							try:
-								os.makedirs(os.path.join(basepath, pathList[0], surfaceName, daytime, str(k-1), str(i//2)))
-							except OSError:
-								pass
-
-						isOriginal = []
-						for m in range(len(coords)):
-							isOriginal.append(os.path.isfile(paths[m]))
-							if not isOriginal[m]:
-								for n in range(1, len(pathList)):
-									paths[m] = os.path.join(basepath, pathList[n], surfaceName, daytime, str(k), str(i+coords[m][0]), str(j+coords[m][1]) + OUTEXT)
-									if os.path.isfile(paths[m]):
-										break
-
-
-						result = Image.new('RGB', (size, size), BACKGROUNDCOLOR)
-
-						imgs = []
-						for m in range(len(coords)):
-							if (os.path.isfile(paths[m])):
-								img = Image.open(paths[m], mode='r').convert("RGB")
-								result.paste(box=(coords[m][0]*size//2, coords[m][1]*size//2), im=img.resize((size//2, size//2), Image.ANTIALIAS))
-
-								if isOriginal[m]:
-									imgs.append((img, paths[m]))
-
-
-						if k == last+1:
-							saveCompress(result, os.path.join(basepath, pathList[0], surfaceName, daytime, str(k-1), str(i//2), str(j//2) + OUTEXT))
-						if OUTEXT != EXT and (k != last+1 or keepLast):
-							result.save(os.path.join(basepath, pathList[0], surfaceName, daytime, str(k-1), str(i//2), str(j//2) + EXT)) 
-							
-						if OUTEXT != EXT:
-							for img, path in imgs:
-								saveCompress(img, path.replace(EXT, OUTEXT), path)
-								os.remove(path)
-
-
-			chunksize = chunksize // 2
+		dirty = None
+		if tiles is not None:
+			dirty = {k: set((x >> start - k, y >> start - k) for x, y in tiles) for k in range(stop, start + 1)}
+		# zoom() always knows the changed tiles, from ref.txt or else from the max zoom folder, so solid tiles are left out in every snapshot.
+		# without them there would be no telling a solid tile of the task below from a missing one.
+		reduceTile(basepath, pathList, surfaceName, daytime, size, start, stop, last, stop, chunk[0], chunk[1], keepLast, dirty, solid if dirty is not None else None)
 	elif stop == last:
 		path = os.path.join(basepath, pathList[0], surfaceName, daytime, str(start), str(chunk[0]), str(chunk[1]))
-		img = Image.open(path + EXT, mode='r').convert("RGB")
-		saveCompress(img, path + OUTEXT, path + EXT)
-		os.remove(path + EXT)   
-		
-
-def thread(basepath, pathList, surfaceName, daytime, size, start, stop, last, allChunks, counter, resultQueue, keepLast=False):
-	#print(start, stop, chunks)
-	while True:
-		with counter.get_lock():
-			i = counter.value - 1
-			if i < 0:
-				return
-			counter.value = i
-		chunk = allChunks[i]
-		work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast)
-		resultQueue.put(True)
+		if os.path.isfile(path + EXT):
+			img = Image.open(path + EXT, mode='r').convert("RGB")
+			saveScreenshot(img, path, start)
+	# the tasks above this one read its top tiles back.
+	pack.flush()
+	return solid, writebehind.flush()
 		
 
-
-
-
-
-
-
-
-
-
 def zoom(*args, **kwargs):
 
 
@@ -244,6 +284,10 @@ def zoom(*args, **kwargs):
 	datapath = os.path.join(toppath, "mapInfo.json")
 	basepath = os.path.join(toppath, "Images")
 	maxthreads = int(kwargs["zoomthreads" if kwargs["zoomthreads"] else "maxthreads"])
+	# the step itself looks up tiles like its workers do.
+	workers.configure(toppath, kwargs)
+
+	pool = workers.acquire(maxthreads, toppath, kwargs)
 
 
 	#print(basepath)
@@ -267,7 +311,7 @@ def zoom(*args, **kwargs):
 					except KeyError: pass
 					for daytime in daytimes:
 						if len(args) <= 3 or daytime == args[3]:
-							if not os.path.isdir(os.path.join(toppath, "Images", str(map["path"]), surfaceName, daytime, str(maxzoom - 1))):
+							if not os.path.isdir(os.path.join(toppath, "Images", str(map["path"]), surfaceName, daytime, str(maxzoom - 1))) and not pack.hasLevel(os.path.join(toppath, "Images", str(map["path"]), surfaceName, daytime), maxzoom - 1):
 
 								print("zoom {:5.1f}% [{}]".format(0, " " * (tsize()[0]-15)), end="")
 
@@ -277,76 +321,73 @@ def zoom(*args, **kwargs):
 												and daytime == daytimes[0]
 
 								allBigChunks = {}
+								allTiles = []
 								minX = float("inf")
 								maxX = float("-inf")
 								minY = float("inf")
 								maxY = float("-inf")
 								imageSize = None
-								for xStr in os.listdir(os.path.join(basepath, str(map["path"]), surfaceName, daytime, str(maxzoom))):
-									x = int(xStr)
+								# ref.txt lists the max zoom tiles this snapshot changed, only their ancestors have to be rendered.
+								folder = os.path.join(basepath, str(map["path"]), surfaceName, daytime)
+								if os.path.isfile(os.path.join(folder, "ref.txt")):
+									with open(os.path.join(folder, "ref.txt"), "r") as f:
+										for line in f:
+											x, y = line.rstrip("\n").split(" ", 2)[:2]
+											allTiles.append((int(x), int(y)))
+								else:
+									for xStr in os.listdir(os.path.join(folder, str(maxzoom))):
+										for yStr in os.listdir(os.path.join(folder, str(maxzoom), xStr)):
+											allTiles.append((int(xStr), int(yStr.split('.', 2)[0])))
+								for x, y in allTiles:
+									if imageSize is None:
+										tilePath = os.path.join(folder, str(maxzoom), str(x), str(y))
+										imageSize = Image.open(tilePath + EXT, mode='r').size[0] if os.path.isfile(tilePath + EXT) else loadTile(codec.tileFile(tilePath, maxzoom)).shape[1]
 									minX = min(minX, x)
 									maxX = max(maxX, x)
-									for yStr in os.listdir(os.path.join(basepath, str(map["path"]), surfaceName, daytime, str(maxzoom), xStr)):
-										if imageSize is None:
-											imageSize = Image.open(os.path.join(basepath, str(map["path"]), surfaceName, daytime, str(maxzoom), xStr, yStr), mode='r').size[0]
-										y = int(yStr.split('.', 2)[0])
-										minY = min(minY, y)
-										maxY = max(maxY, y)
-										allBigChunks[(x >> maxzoom - minzoom, y >> maxzoom - minzoom)] = True
+									minY = min(minY, y)
+									maxY = max(maxY, y)
+									allBigChunks[(x >> maxzoom - minzoom, y >> maxzoom - minzoom)] = True
 
 
 								pathList = []
 								for otherMapIndex in range(mapIndex, -1, -1):
 									pathList.append(str(data["maps"][otherMapIndex]["path"]))
 
-								threadsplit = 0
-								while 4**threadsplit * len(allBigChunks) < maxthreads:
-									threadsplit = threadsplit + 1
-								threadsplit = min(max(maxzoom - minzoom - 3, 0), threadsplit + 3)
-								allChunks = []
-								for pos in list(allBigChunks):
-									for i in range(2**threadsplit):
-										for j in range(2**threadsplit):
-											allChunks.append((pos[0]*(2**threadsplit) + i, pos[1]*(2**threadsplit) + j))
-
-								threads = min(len(allChunks), maxthreads)
-								processes = []
-								originalSize = len(allChunks)
-								
-								# print(("%s %s %s %s" % (pathList[0], str(surfaceName), daytime, pathList)))
-								# print(("%s-%s (total: %s):" % (start, stop + threadsplit, len(allChunks))))
-								counter = mp.Value('i', originalSize)
-								resultQueue = mp.Queue()
-								for _ in range(0, threads):
-									p = mp.Process(target=thread, args=(basepath, pathList, surfaceName, daytime, imageSize, maxzoom, minzoom + threadsplit, minzoom, allChunks, counter, resultQueue, generateThumbnail))
-									p.start()
-									processes.append(p)
-								
-								doneSize = 0
-								for _ in range(originalSize):
-									resultQueue.get(True)
-									doneSize += 1
+								# split the pyramid at the lowest level that still gives every worker a few subtrees to start on.
+								# tasks below the split are independent, everything above it is reduced by tasks that wait for the ones under them.
+								splitLevel = minzoom
+								while splitLevel < maxzoom - 1 and len(set((x >> maxzoom - splitLevel, y >> maxzoom - splitLevel) for x, y in allTiles)) < TASKSPERTHREAD * maxthreads:
+									splitLevel = splitLevel + 1
+
+								# every task reduces a subtree of at most memoryLevels levels in memory, its root is read back from disk by the task above it.
+								# the reduction is depth first, so a worker only holds the tiles along one branch: ZOOMTILESPERLEVEL tiles for every level, not the whole subtree.
+								memoryLevels = max(1, int(kwargs.get("zoommemory") or ZOOMMEMORY) * 2**20 // (ZOOMTILESPERLEVEL * 3 * (imageSize or 1)**2))
+								scheduler = Scheduler(pool, maxthreads)
+								level = maxzoom
+								previousStop = None
+								while level > minzoom or previousStop is None:
+									stop = max(level - memoryLevels, splitLevel if level > splitLevel else minzoom)
+									chunkTiles = {}
+									for x, y in set((x >> maxzoom - level, y >> maxzoom - level) for x, y in allTiles):
+										chunkTiles.setdefault((x >> level - stop, y >> level - stop), []).append((x, y))
+									for chunk, tiles in chunkTiles.items():
+										after = []
+										if previousStop is not None:
+											after = [(previousStop, x, y) for x, y in tiles]
+										scheduler.add((stop, *chunk), work, (basepath, pathList, surfaceName, daytime, imageSize, level, stop, minzoom, chunk, generateThumbnail, tiles), after)
+									previousStop = stop
+									level = stop
+
+								def progress(doneSize, originalSize):
 									progress = float(doneSize) / originalSize
 									tsiz = tsize()[0]-15
 									print("\rzoom {:5.1f}% [{}{}]".format(round(progress * 98, 1), "=" * int(progress * tsiz), " " * (tsiz - int(progress * tsiz))), end="")
-
-								for p in processes:
-									p.join()
-								
-
-								
-
-								if threadsplit > 0:
-									#print(("finishing up: %s-%s (total: %s)" % (stop + threadsplit, stop, len(allBigChunks))))
-									processes = []
-									i = len(allBigChunks) - 1
-									for chunk in list(allBigChunks):
-										p = mp.Process(target=work, args=(basepath, pathList, surfaceName, daytime, imageSize, minzoom + threadsplit, minzoom, minzoom, chunk, generateThumbnail))
-										i = i - 1
-										p.start()
-										processes.append(p)
-									for p in processes:
-										p.join()
+								# print(("%s %s %s %s" % (pathList[0], str(surfaceName), daytime, pathList)))
+								results = scheduler.run(progress)
+								pack.checkpoint(folder)
+								chunks.saveSolid(os.path.join(folder, chunks.SOLIDFILE), [tile for solid, _ in results.values() for tile in solid])
+								if kwargs.get("verbose"):
+									printErase(writebehind.describe(functools.reduce(writebehind.addStats, (stats for _, stats in results.values()), writebehind.newStats())))
 
 
 								if generateThumbnail:
@@ -354,36 +395,25 @@ def zoom(*args, **kwargs):
 									minzoompath = os.path.join(basepath, str(map["path"]), surfaceName, daytime, str(minzoom))
 
 
-									thumbnail = Image.new('RGB', ((maxX-minX+1) * imageSize >> maxzoom-minzoom, (maxY-minY+1) * imageSize >> maxzoom-minzoom), BACKGROUNDCOLOR)
 									bigMinX = minX >> maxzoom-minzoom
 									bigMinY = minY >> maxzoom-minzoom
 									xOffset = ((bigMinX * imageSize << maxzoom-minzoom) - minX * imageSize) >> maxzoom-minzoom
 									yOffset = ((bigMinY * imageSize << maxzoom-minzoom) - minY * imageSize) >> maxzoom-minzoom
-									for chunk in list(allBigChunks):
-										path = os.path.join(minzoompath, str(chunk[0]), str(chunk[1]) + EXT)
-										thumbnail.paste(box=(xOffset+(chunk[0]-bigMinX)*imageSize, yOffset+(chunk[1]-bigMinY)*imageSize), im=Image.open(path, mode='r').convert("RGB").resize((imageSize, imageSize), Image.ANTIALIAS))
-
-										if OUTEXT != EXT:
-											os.remove(path)
-
-									thumbnail.save(os.path.join(basepath, "thumbnail" + THUMBNAILEXT))
+									# unless the tiles themselves are loose pngs, the full color copies were only written for the thumbnail.
+									thumbnail.build(pool, maxthreads, os.path.join(basepath, "thumbnail.png"),
+													{(chunk[0] - bigMinX, chunk[1] - bigMinY): os.path.join(minzoompath, str(chunk[0]), str(chunk[1]) + EXT) for chunk in allBigChunks},
+													(maxX-minX+1) * imageSize >> maxzoom-minzoom, (maxY-minY+1) * imageSize >> maxzoom-minzoom, (xOffset, yOffset), imageSize, BACKGROUNDCOLOR,
+													int(kwargs.get("thumbnailsize") or 0), codec.extension(minzoom) != EXT or pack.enabled())
 									
 
 
 									
 								print("\rzoom {:5.1f}% [{}]".format(100, "=" * (tsize()[0]-15)))
 
-
-
-						
-
-				
-
-
+	workers.release(pool)
 
 
 
-				
 
 
 if __name__ == '__main__':